@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import argparse
+import datetime
+import platform
+import numpy as np
+import cross_sections_data as csd
+import monte_carlo_initialisations as mci
+import calculating_geometric_properties as cgp
+import compton_scattering as cs
+import energy_calculation as ec
+import random_streams as rs
+import transport_simulation as ts
+
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plots_and_data')
+CROSS_SECTIONS_FILE = os.path.join(DATA_DIR, 'cross_sections_data.txt')
+REFERENCE_FILE = os.path.join(DATA_DIR, 'benchmark_reference.json')
+HISTORY_FILE = os.path.join(DATA_DIR, 'benchmark_history.jsonl')
+
+NaI_DENSITY = 3.67
+
+SCENARIOS = {
+    'A': {'source_position': [3.0, -3.0, 2.0], 'source_energy': 0.6617, 'detector_height': 3.0, 'detector_radius': 2.5},
+    'B': {'source_position': [4.0, 4.0, 0.0], 'source_energy': 1.3325, 'detector_height': 5.0, 'detector_radius': 3.0},
+    'pair': {'source_position': [4.0, 4.0, 0.0], 'source_energy': 4.0, 'detector_height': 5.0, 'detector_radius': 3.0},
+}
+
+
+def _best_time(function, repeats=5):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def benchmark_kernels(seed=0, num_scalar=2000, num_batch=100000, repeats=5):
+    rng = np.random.default_rng(seed)
+
+    energy, compton, photo, pair = csd.read_cross_sections(CROSS_SECTIONS_FILE)
+    energy = csd.make_energy_unique(energy)
+    table = csd.load_cross_section_table(CROSS_SECTIONS_FILE, NaI_DENSITY)
+
+    energies = np.exp(rng.uniform(np.log(0.01), np.log(4.0), num_batch))
+    directions = mci.isotropic_directions_in_angle(np.pi, num_batch, rng)
+    positions = rng.uniform(-1, 1, (num_batch, 3)) * [2.0, 2.0, 1.5]
+    lambd = rng.exponential(1.0, num_batch)
+    scalar = range(num_scalar)
+
+    def scalar_loop(function):
+        return lambda: [function(i) for i in scalar]
+
+    def fill_histogram():
+        ec.EnergyHistogram(num_bins=ts.RAW_SPECTRUM_BINS, energy_min=0., energy_max=4.4).add(energies)
+
+    # every kernel gets its own generator, so the timed work does not depend on the order they run in
+    kernels = {
+        'get_cross_section': (scalar_loop(lambda i: csd.get_cross_section(energies[i], energy, compton)), num_scalar),
+        'cross_section_lookup': (scalar_loop(lambda i: table.lookup(energies[i])), num_scalar),
+        'cross_section_lookup_batch': (lambda: table.lookup(energies), num_batch),
+        'photon_angle': (scalar_loop(lambda i: mci.photon_angle(energies[i], kernel_rng)), num_scalar),
+        'compton_scatter_photon': (scalar_loop(lambda i: mci.compton_scatter_photon(energies[i], directions[i], kernel_rng)), num_scalar),
+        'compton_scatter_photons': (lambda: cs.compton_scatter_photons(energies, directions, kernel_rng), num_batch),
+        'intersect_cylinder_out': (scalar_loop(lambda i: cgp.intersect_cylinder_out(positions[i], directions[i], 1.5, -1.5, 2.5)), num_scalar),
+        'goes_outside': (scalar_loop(lambda i: cgp.goes_outside(positions[i], directions[i], 1.5, -1.5, 2.5, lambd[i])), num_scalar),
+        'goes_outside_batch': (lambda: cgp.goes_outside_batch(positions, directions, 1.5, -1.5, 2.5, lambd), num_batch),
+        'energy_histogram_add': (fill_histogram, num_batch),
+    }
+
+    results = {}
+    for name, (function, calls) in kernels.items():
+        kernel_rng = np.random.default_rng(seed)
+        seconds = _best_time(function, repeats)
+        results[name] = {'calls': calls, 'seconds': seconds, 'calls_per_second': calls / seconds}
+
+    return results
+
+
+def physics_metrics(energy_histogram, source_energy, num_particles, num_reached, efficiency_tot, efficiency_int, weighted=False):
+    error_tot, error_int = ec.efficiency_relative_errors(energy_histogram, num_particles, num_reached)
+
+    metrics = {
+        'efficiency_tot': (efficiency_tot, efficiency_tot * error_tot),
+        'efficiency_int': (efficiency_int, efficiency_int * error_int),
+    }
+
+    # the binomial window errors below only hold for unweighted counts
+    if weighted:
+        return {name: {'value': float(value), 'error': float(error)} for name, (value, error) in metrics.items()}
+
+    alpha = source_energy / 0.511
+    compton_edge = source_energy * 2 * alpha / (1 + 2 * alpha)
+    half_width = 0.005 * source_energy
+
+    windows = {
+        'photopeak': (source_energy - half_width, source_energy + half_width),
+        'compton_edge': (0.9 * compton_edge, compton_edge + half_width),
+    }
+    if source_energy > 1.022:
+        windows['single_escape'] = (source_energy - 0.511 - half_width, source_energy - 0.511 + half_width)
+        windows['double_escape'] = (source_energy - 1.022 - half_width, source_energy - 1.022 + half_width)
+
+    # window counts per sampled history, binomial errors
+    for name, (energy_low, energy_high) in windows.items():
+        p = ec.window_counts(energy_histogram, energy_low, energy_high) / num_particles
+        metrics[name] = (p, np.sqrt(p * (1 - p) / num_particles))
+
+    return {name: {'value': float(value), 'error': float(error)} for name, (value, error) in metrics.items()}
+
+
+def compare_to_reference(metrics, reference, tolerance=4.0):
+    checks = {}
+    for name, expected in reference.items():
+        if name not in metrics:
+            continue
+
+        sigma = np.hypot(metrics[name]['error'], expected['error'])
+        difference = metrics[name]['value'] - expected['value']
+        deviation = difference / sigma if sigma > 0 else (0. if difference == 0 else np.inf)
+
+        checks[name] = {'deviation': float(deviation), 'passed': bool(abs(deviation) <= tolerance)}
+
+    return checks
+
+
+def spectrum_parity(energy_histogram, reference_histogram, rebin=64, num_particles=None, reference_particles=None):
+    import scipy.stats
+
+    # chi-square test that two raw spectra come from the same distribution, on wide bins so that few are sparse
+    counts = np.array([energy_histogram.hist, reference_histogram.hist]).reshape(2, -1, rebin).sum(axis=2)
+
+    # with the numbers of sampled histories the ones that deposited nothing are a cell too, so the efficiencies are tested
+    # along with the shape
+    if num_particles is not None and reference_particles is not None:
+        missed = [[num_particles - energy_histogram.count], [reference_particles - reference_histogram.count]]
+        counts = np.hstack([counts, missed])
+
+    counts = counts[:, counts.sum(axis=0) > 0]
+    _, p_value, degrees_of_freedom, _ = scipy.stats.chi2_contingency(counts)
+
+    return {'p_value': float(p_value), 'degrees_of_freedom': int(degrees_of_freedom)}
+
+
+def run_scenario(name, num_particles, seed=0, batch_size=rs.DEFAULT_BLOCK_SIZE, workers=1, variance_reduction=None, backend=None):
+    scenario = SCENARIOS[name]
+
+    start = time.perf_counter()
+    energy_histogram, efficiency_tot, efficiency_int, stats = ts.record_gamma_spectrum(
+        np.array(scenario['source_position']), scenario['source_energy'], scenario['detector_height'],
+        scenario['detector_radius'], NaI_DENSITY, None, num_particles, cross_sections_file_path=CROSS_SECTIONS_FILE,
+        batch_size=batch_size, workers=workers, seed=seed, profile=True, variance_reduction=variance_reduction, backend=backend)
+    elapsed_time = time.perf_counter() - start
+
+    metrics = physics_metrics(energy_histogram, scenario['source_energy'], num_particles, stats.counters['reached'],
+                              efficiency_tot, efficiency_int, weighted=variance_reduction is not None)
+
+    if variance_reduction is not None:
+        engine = 'weighted'
+    elif backend == 'numba':
+        engine = 'numba'
+    else:
+        engine = 'scalar' if batch_size is None and workers == 1 else 'batch'
+
+    # 1 / (relative variance x time) of the intrinsic efficiency
+    relative_error = metrics['efficiency_int']['error'] / metrics['efficiency_int']['value']
+
+    return {
+        'num_particles': num_particles,
+        'engine': engine,
+        'workers': workers,
+        'seconds': elapsed_time,
+        'photons_per_second': num_particles / elapsed_time,
+        'figure_of_merit': 1 / (relative_error**2 * elapsed_time) if relative_error > 0 else None,
+        'metrics': metrics,
+        'stats': stats.to_dict(),
+        'histogram': energy_histogram,
+    }
+
+
+def load_reference(path=REFERENCE_FILE):
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the transport kernels and whole-run scenarios and check the physics against reference values.')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--num-particles', type=int, default=200000)
+    parser.add_argument('--scalar-particles', type=int, default=0,
+                        help='also run every scenario on the scalar engine with this many photons')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--variance-reduction', action='store_true',
+                        help='also run every scenario with forced first interaction and Russian roulette')
+    parser.add_argument('--numba', action='store_true',
+                        help='also run every scenario on the compiled kernel and test its spectrum against the batch engine')
+    parser.add_argument('--parity-level', type=float, default=0.001, help='smallest accepted p-value of the spectrum parity test')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tolerance', type=float, default=4.0, help='allowed deviation in combined standard errors')
+    parser.add_argument('--skip-kernels', action='store_true')
+    parser.add_argument('--history', default=HISTORY_FILE)
+    parser.add_argument('--update-reference', action='store_true',
+                        help='store this run as the reference instead of checking against it')
+    args = parser.parse_args()
+
+    record = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'seed': args.seed,
+    }
+
+    if not args.skip_kernels:
+        record['kernels'] = benchmark_kernels(args.seed)
+        for name, result in record['kernels'].items():
+            print(f"{name:28s} {result['calls_per_second']:14.0f} calls/s")
+
+    reference = {} if args.update_reference else load_reference()
+    passed = True
+
+    runs = [(name, args.num_particles, rs.DEFAULT_BLOCK_SIZE, None, None) for name in args.scenarios]
+    if args.scalar_particles:
+        runs += [(name, args.scalar_particles, None, None, None) for name in args.scenarios]
+    if args.variance_reduction:
+        variance_reduction = ts.VarianceReduction(roulette_energy=0.05)
+        runs += [(name, args.num_particles, rs.DEFAULT_BLOCK_SIZE, variance_reduction, None) for name in args.scenarios]
+    if args.numba:
+        import numba_transport as nt
+        record['numba'] = nt.NUMBA_AVAILABLE and nt.numba.__version__
+        # without numba the backend falls back to the batch engine, whose timings would be recorded under the wrong name
+        if nt.NUMBA_AVAILABLE:
+            runs += [(name, args.num_particles, rs.DEFAULT_BLOCK_SIZE, None, 'numba') for name in args.scenarios]
+        else:
+            print("numba is not installed, skipping the compiled kernel runs")
+
+    record['scenarios'] = {}
+    histograms = {}
+    for name, num_particles, batch_size, variance_reduction, backend in runs:
+        result = run_scenario(name, num_particles, args.seed, batch_size, args.workers if batch_size else 1, variance_reduction,
+                              backend)
+        key = f"{name}/{result['engine']}"
+        histograms[key] = result.pop('histogram')
+
+        if name in reference:
+            result['checks'] = compare_to_reference(result['metrics'], reference[name], args.tolerance)
+            passed &= all(check['passed'] for check in result['checks'].values())
+
+        # the compiled kernel draws its own random numbers, so it can only agree with the batch engine statistically
+        if backend == 'numba':
+            result['parity'] = spectrum_parity(histograms[key], histograms[f"{name}/batch"], num_particles=num_particles,
+                                               reference_particles=args.num_particles)
+            result['parity']['passed'] = result['parity']['p_value'] >= args.parity_level
+            passed &= result['parity']['passed']
+
+        record['scenarios'][key] = result
+
+        failed = [metric for metric, check in result.get('checks', {}).items() if not check['passed']]
+        if not result.get('parity', {}).get('passed', True):
+            failed.append('spectrum parity')
+        status = 'no reference' if 'checks' not in result and 'parity' not in result else ('FAILED ' + ', '.join(failed) if failed else 'ok')
+        print(f"{key:28s} {result['photons_per_second']:14.0f} photons/s   FOM {result['figure_of_merit'] or 0:12.0f}   physics: {status}")
+
+    record['passed'] = bool(passed)
+
+    if args.update_reference:
+        reference = load_reference()
+        for key, result in record['scenarios'].items():
+            if key.endswith('/batch'):
+                reference[key.split('/')[0]] = result['metrics']
+        with open(REFERENCE_FILE, 'w') as file:
+            json.dump(reference, file, indent=2)
+
+    with open(args.history, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,20 @@
+import os
+import hashlib
+import numpy as np
+
+
+def file_hash(filepath):
+    with open(filepath, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
+def atomic_savez(path, arrays, compressed=False):
+    # written next to the target and renamed, so concurrent readers never see a half-written file
+    temporary_path = f"{path}.{os.getpid()}.tmp.npz"
+    try:
+        (np.savez_compressed if compressed else np.savez)(temporary_path, **arrays)
+        os.replace(temporary_path, path)
+    except OSError:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
@@ -1,4 +1,5 @@
 import numpy as np
+import profiling as prof
 
 
 def calc_angle_of_cone(source_position, detector_height, detector_radius):
@@ -97,6 +98,7 @@ def intersect_cylinder_out(position, direction, pztop, pzbottom, radius):
     return dist
 
 
+@prof.timed('geometry')
 def intersect_cylinder_starting_points(position, direction, pztop, pzbottom, radius):
     dist = intersect_cylinder_out(position, direction, pztop, pzbottom, radius)
     if dist != np.inf:
@@ -106,7 +108,85 @@ def intersect_cylinder_starting_points(position, direction, pztop, pzbottom, rad
         return None
     
 
+@prof.timed('geometry')
 def goes_outside(position, direction, pztop, pzbottom, radius, lambd):
     dist = intersect_cylinder_in(position, direction, pztop, pzbottom, radius)
     out = dist < lambd
-    return out
\ No newline at end of file
+    return out
+
+
+def intersect_cylinder_batch(positions, directions, radius):
+    a = directions[:, 0]**2 + directions[:, 1]**2
+    b = positions[:, 0] * directions[:, 0] + positions[:, 1] * directions[:, 1]
+    c = positions[:, 0]**2 + positions[:, 1]**2 - radius**2
+    d = b**2 - a * c
+
+    # rays parallel to the axis are inside the mantle for every t or for none
+    parallel = a < 1e-14
+    inside = c <= 0
+
+    # numerically stable roots, so rays starting on the surface get an exact 0
+    q = -(b + np.copysign(np.sqrt(np.maximum(d, 0)), b))
+    root_a = q / np.where(parallel, 1.0, a)
+    root_b = np.where(q != 0, c / np.where(q != 0, q, 1.0), root_a)
+
+    t_near = np.where(d < 0, np.inf, np.minimum(root_a, root_b))
+    t_far = np.where(d < 0, -np.inf, np.maximum(root_a, root_b))
+
+    t_near = np.where(parallel, np.where(inside, -np.inf, np.inf), t_near)
+    t_far = np.where(parallel, np.where(inside, np.inf, -np.inf), t_far)
+
+    return np.column_stack([t_near, t_far])
+
+
+def intersect_slab_batch(positions, directions, pztop, pzbottom):
+    parallel = np.abs(directions[:, 2]) < 1e-14
+    inside = (positions[:, 2] >= pzbottom) & (positions[:, 2] <= pztop)
+
+    dz = np.where(parallel, 1.0, directions[:, 2])
+    d_plus = (pztop - positions[:, 2]) / dz
+    d_minus = (pzbottom - positions[:, 2]) / dz
+
+    t_near = np.where(parallel, np.where(inside, -np.inf, np.inf), np.minimum(d_plus, d_minus))
+    t_far = np.where(parallel, np.where(inside, np.inf, -np.inf), np.maximum(d_plus, d_minus))
+
+    return np.column_stack([t_near, t_far])
+
+
+def cylinder_chord_batch(positions, directions, pztop, pzbottom, radius):
+    t_cyl = intersect_cylinder_batch(positions, directions, radius)
+    t_slab = intersect_slab_batch(positions, directions, pztop, pzbottom)
+
+    t_near = np.maximum(t_cyl[:, 0], t_slab[:, 0])
+    t_far = np.minimum(t_cyl[:, 1], t_slab[:, 1])
+
+    return t_near, t_far
+
+
+def intersect_cylinder_in_batch(positions, directions, pztop, pzbottom, radius):
+    t_near, t_far = cylinder_chord_batch(positions, directions, pztop, pzbottom, radius)
+
+    return np.where(t_near <= t_far, np.maximum(t_far, 0.0), 0.0)
+
+
+def intersect_cylinder_out_batch(positions, directions, pztop, pzbottom, radius):
+    t_near, t_far = cylinder_chord_batch(positions, directions, pztop, pzbottom, radius)
+
+    return np.where((t_near < t_far) & (t_far > 0), np.maximum(t_near, 0.0), np.inf)
+
+
+@prof.timed('geometry')
+def intersect_cylinder_starting_points_batch(positions, directions, pztop, pzbottom, radius):
+    dist = intersect_cylinder_out_batch(positions, directions, pztop, pzbottom, radius)
+    hit = np.isfinite(dist)
+
+    points = positions[hit] + dist[hit, None] * directions[hit]
+
+    return points, hit
+
+
+@prof.timed('geometry')
+def goes_outside_batch(positions, directions, pztop, pzbottom, radius, lambd):
+    dist = intersect_cylinder_in_batch(positions, directions, pztop, pzbottom, radius)
+    out = dist < lambd
+    return out
@@ -0,0 +1,63 @@
+import numpy as np
+import profiling as prof
+
+
+def sample_klein_nishina(energies_in, rng):
+    energies_in = np.asarray(energies_in, dtype=float)
+    alpha = energies_in / 0.511
+
+    epsilon = np.empty(energies_in.shape)
+    pending = np.arange(energies_in.size)
+
+    # Kahn's rejection method, only the rejected entries are drawn again
+    while pending.size:
+        a = alpha[pending]
+        r1, r2, r3 = rng.random((3, pending.size))
+
+        first_branch = r1 <= (1 + 2 * a) / (9 + 2 * a)
+        eps = np.where(first_branch, 1 + 2 * a * r2, (1 + 2 * a) / (1 + 2 * a * r2))
+        costheta = 1 - (eps - 1) / a
+        g = np.where(first_branch, 4 * (1 / eps - 1 / eps**2), (costheta**2 + 1 / eps) / 2)
+
+        accepted = r3 <= g
+        epsilon[pending[accepted]] = eps[accepted]
+        pending = pending[~accepted]
+
+    costheta = np.clip(1 - (epsilon - 1) / alpha, -1, 1)
+
+    return costheta, energies_in / epsilon
+
+
+def rotate_directions(directions, costheta, phi):
+    u, v, w = directions[:, 0], directions[:, 1], directions[:, 2]
+
+    sintheta = np.sqrt(1 - costheta**2)
+    cosphi = np.cos(phi)
+    sinphi = np.sin(phi)
+
+    perp = np.sqrt(np.maximum(1 - w**2, 0))
+    along_z = perp < 1e-8
+    perp = np.where(along_z, 1.0, perp)
+
+    new_directions = np.empty(directions.shape)
+    new_directions[:, 0] = np.where(along_z, sintheta * cosphi,
+                                    sintheta * (u * w * cosphi - v * sinphi) / perp + u * costheta)
+    new_directions[:, 1] = np.where(along_z, sintheta * sinphi,
+                                    sintheta * (v * w * cosphi + u * sinphi) / perp + v * costheta)
+    new_directions[:, 2] = np.where(along_z, np.sign(w) * costheta,
+                                    w * costheta - sintheta * cosphi * perp)
+
+    return new_directions
+
+
+@prof.timed('compton_sampling')
+def compton_scatter_photons(energies_in, directions, rng):
+    energies_in = np.asarray(energies_in, dtype=float)
+
+    costheta, energies_out = sample_klein_nishina(energies_in, rng)
+    phi = 2 * np.pi * rng.random(energies_in.size)
+
+    directions = rotate_directions(directions, costheta, phi)
+    detector_energies = energies_in - energies_out
+
+    return directions, energies_out, detector_energies
@@ -1,5 +1,13 @@
+import os
+import math
+import hashlib
 import numpy as np
-import scipy.interpolate
+import profiling as prof
+import cache_files as cf
+
+
+CACHE_FORMAT_VERSION = 1
+CACHE_DIR_NAME = '.cross_section_cache'
 
 
 def read_cross_sections(filepath):
@@ -34,14 +42,16 @@ def read_cross_sections(filepath):
 
 
 def make_energy_unique(energy, epsilon=1e-9):
-    energy = energy.copy()
-    for i in range(1, len(energy)):
-        while energy[i] <= energy[i - 1]:
-            energy[i] = energy[i - 1] + epsilon
-    return energy
+    energy = np.asarray(energy, dtype=float)
+    steps = epsilon * np.arange(len(energy))
+
+    # energy[i] = max(energy[i], energy[i - 1] + epsilon) applied left to right, as a running maximum
+    return np.maximum.accumulate(energy - steps) + steps
 
 
 def get_cross_section(current_energy, energy, cross_section):
+    import scipy.interpolate
+
     energy = np.array(energy)
     cross_section = np.array(cross_section)
     
@@ -52,3 +62,135 @@ def get_cross_section(current_energy, energy, cross_section):
     
     return interpolated_cross_section(current_energy)
 
+
+class CrossSectionTable:
+    def __init__(self, energy, compton_scattering_cross_sections, photoelectric_absorption_cross_sections,
+                 pair_production_cross_sections, num_points=8192):
+        energy = np.asarray(energy, dtype=float)
+        cross_sections = [np.asarray(cs, dtype=float) for cs in (compton_scattering_cross_sections,
+                                                                  photoelectric_absorption_cross_sections,
+                                                                  pair_production_cross_sections)]
+
+        if any(len(cs) != len(energy) for cs in cross_sections):
+            raise ValueError("Energy and cross section arrays must have the same length.")
+        if num_points < 2:
+            raise ValueError("The cross section grid needs at least two points.")
+
+        energy = make_energy_unique(energy)
+
+        self.energy = energy
+        self.energy_min = energy[0]
+        self.energy_max = energy[-1]
+        self.num_points = num_points
+
+        # dense grid, uniform in log(E), so a lookup is index arithmetic instead of a search
+        self.log_energy_min = np.log(self.energy_min)
+        self.log_step = (np.log(self.energy_max) - self.log_energy_min) / (num_points - 1)
+        self.grid = np.exp(self.log_energy_min + self.log_step * np.arange(num_points))
+        self.grid[0] = self.energy_min
+        self.grid[-1] = self.energy_max
+
+        channels = np.array([np.interp(self.grid, energy, cs) for cs in cross_sections])
+        self.values = np.vstack([channels, channels.sum(axis=0)])
+
+    def to_arrays(self):
+        return {'energy': self.energy, 'grid': self.grid, 'values': self.values,
+                'log_grid': np.array([self.log_energy_min, self.log_step])}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        energy = np.asarray(arrays['energy'], dtype=float)
+        grid = np.asarray(arrays['grid'], dtype=float)
+        values = np.asarray(arrays['values'], dtype=float)
+        log_energy_min, log_step = np.asarray(arrays['log_grid'], dtype=float)
+
+        if values.shape != (4, len(grid)) or len(grid) < 2 or len(energy) < 2:
+            raise ValueError("Cross section table arrays have inconsistent shapes.")
+        if not (np.all(np.isfinite(values)) and np.all(np.diff(grid) > 0) and np.all(np.diff(energy) > 0)):
+            raise ValueError("Cross section table arrays are not finite and increasing.")
+
+        table = cls.__new__(cls)
+        table.energy = energy
+        table.energy_min = energy[0]
+        table.energy_max = energy[-1]
+        table.num_points = len(grid)
+        table.log_energy_min = log_energy_min
+        table.log_step = log_step
+        table.grid = grid
+        table.values = values
+
+        return table
+
+    @prof.timed('cross_section_lookup')
+    def lookup(self, current_energy):
+        if np.ndim(current_energy) == 0:
+            return self._lookup_scalar(float(current_energy))
+
+        current_energy = np.asarray(current_energy, dtype=float)
+        inside = (current_energy >= self.energy_min) & (current_energy <= self.energy_max)
+
+        x = (np.log(np.clip(current_energy, self.energy_min, self.energy_max)) - self.log_energy_min) / self.log_step
+        index = np.minimum(x.astype(int), self.num_points - 2)
+        fraction = x - index
+
+        values = self.values[:, index] * (1 - fraction) + self.values[:, index + 1] * fraction
+
+        return np.where(inside, values, 0.0)
+
+    def _lookup_scalar(self, current_energy):
+        if not self.energy_min <= current_energy <= self.energy_max:
+            return np.zeros(4)
+
+        x = (math.log(current_energy) - self.log_energy_min) / self.log_step
+        index = min(int(x), self.num_points - 2)
+        fraction = x - index
+
+        return self.values[:, index] * (1 - fraction) + self.values[:, index + 1] * fraction
+
+
+def cache_key(filepath, density, num_points):
+    file_hash = cf.file_hash(filepath)
+
+    return hashlib.sha256(f"{CACHE_FORMAT_VERSION}:{file_hash}:{float(density)!r}:{num_points}".encode()).hexdigest()
+
+
+def _read_cached_table(cache_path, key):
+    try:
+        with np.load(cache_path) as arrays:
+            if str(arrays['key']) != key:
+                return None
+            return CrossSectionTable.from_arrays(arrays)
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _write_cached_table(cache_path, key, table):
+    # the cache is only an optimisation, so a table that cannot be written is simply loaded again next time
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        cf.atomic_savez(cache_path, {'key': np.array(key), **table.to_arrays()})
+    except OSError:
+        pass
+
+
+def load_cross_section_table(filepath, density, num_points=8192, cache_dir=None, use_cache=True):
+    if use_cache:
+        key = cache_key(filepath, density, num_points)
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)), CACHE_DIR_NAME)
+        cache_path = os.path.join(cache_dir, f"{key[:32]}.npz")
+
+        table = _read_cached_table(cache_path, key)
+        if table is not None:
+            return table
+
+    energy, compton_scattering_cross_sections, photoelectric_absorption_cross_sections, pair_production_cross_sections = read_cross_sections(filepath)
+
+    table = CrossSectionTable(energy, compton_scattering_cross_sections * density,
+                              photoelectric_absorption_cross_sections * density,
+                              pair_production_cross_sections * density, num_points=num_points)
+
+    if use_cache:
+        _write_cached_table(cache_path, key, table)
+
+    return table
@@ -0,0 +1,56 @@
+import numpy as np
+import energy_calculation as ec
+
+
+RESOLUTION_MODELS = ('constant', 'proportional', 'sqrt')
+
+
+def fwhm_at(energies, FWHM, model='constant'):
+    energies = np.asarray(energies, dtype=float)
+
+    if callable(model):
+        return np.broadcast_to(np.asarray(model(energies), dtype=float), energies.shape)
+    if model == 'constant':
+        return np.full(energies.shape, float(FWHM))
+    if model == 'proportional':
+        return FWHM * energies
+    if model == 'sqrt':
+        return FWHM * np.sqrt(np.maximum(energies, 0))
+
+    raise ValueError(f"Unknown resolution model: {model}")
+
+
+def broaden_histogram(raw_histogram, FWHM, model='constant', num_bins=1024, energy_min=None, energy_max=None):
+    import scipy.special
+
+    energy_min = raw_histogram.energy_min if energy_min is None else energy_min
+    energy_max = raw_histogram.energy_max if energy_max is None else energy_max
+
+    broadened = ec.EnergyHistogram(num_bins=num_bins, energy_min=energy_min, energy_max=energy_max)
+
+    raw_counts, raw_edges = raw_histogram.get_histogram()
+    filled = np.flatnonzero(raw_counts)
+    counts = raw_counts[filled]
+    centers = (raw_edges[filled] + raw_edges[filled + 1]) / 2
+    sigma = np.maximum(fwhm_at(centers, FWHM, model) / 2.3548, 1e-12)
+
+    # sparse convolution: every filled raw bin only reaches the output bins within 6 sigma of it
+    half_width = int(np.ceil(6 * sigma.max() / broadened.bin_width)) + 1 if len(filled) else 0
+    first_edge = np.floor((centers - energy_min) / broadened.bin_width).astype(np.int64) - half_width
+    edge_index = first_edge[:, None] + np.arange(2 * half_width + 2)
+    edge_energy = energy_min + np.clip(edge_index, 0, num_bins) * broadened.bin_width
+
+    cdf = scipy.special.ndtr((edge_energy - centers[:, None]) / sigma[:, None])
+    bin_index = edge_index[:, :-1]
+    in_range = (bin_index >= 0) & (bin_index < num_bins)
+
+    weights = (counts[:, None] * np.diff(cdf, axis=1))[in_range]
+    broadened.hist += np.bincount(bin_index[in_range], weights=weights, minlength=num_bins)
+
+    broadened.count = raw_histogram.count
+    broadened.sum = raw_histogram.sum
+    broadened.sum_of_squares = raw_histogram.sum_of_squares + float(np.sum(counts * sigma**2))
+    broadened.underflow = raw_histogram.underflow + float(np.sum(counts * scipy.special.ndtr((energy_min - centers) / sigma)))
+    broadened.overflow = raw_histogram.overflow + float(np.sum(counts * scipy.special.ndtr((centers - energy_max) / sigma)))
+
+    return broadened
@@ -0,0 +1,215 @@
+import json
+import argparse
+import numpy as np
+import cache_files as cf
+import energy_calculation as ec
+import random_streams as rs
+import sweeps
+
+
+QUANTITIES = ('efficiency_tot', 'efficiency_int', 'efficiency_photopeak')
+
+# interpolated in log space, as they fall off roughly with the square of the distance
+LOG_QUANTITIES = (True, False, True)
+
+
+def _node_efficiencies(result):
+    histogram = result['histogram']
+    n = result['num_particles']
+    source_energy = result['config']['source_energy']
+    emitted = result['emitted_per_sampled'] * n
+    num_reached = result['blocks']['E_int'].sum() / source_energy
+
+    error_tot, error_int = ec.efficiency_relative_errors(histogram, n, max(num_reached, 1))
+
+    # full-energy deposits of the raw spectrum, binomial errors
+    half_width = 0.005 * source_energy
+    photopeak = ec.window_counts(histogram, source_energy - half_width, source_energy + half_width)
+    photopeak_error = np.sqrt(photopeak * (1 - photopeak / n)) if n else 0.
+
+    values = (result['efficiency_tot'], result['efficiency_int'], photopeak / emitted)
+    errors = (result['efficiency_tot'] * error_tot if np.isfinite(error_tot) else np.inf,
+              result['efficiency_int'] * error_int if np.isfinite(error_int) else np.inf,
+              photopeak_error / emitted)
+
+    return values, errors
+
+
+class EfficiencyMap:
+    def __init__(self, r_nodes, z_nodes, values, errors, metadata=None):
+        self.r_nodes = np.asarray(r_nodes, dtype=float)
+        self.z_nodes = np.asarray(z_nodes, dtype=float)
+        self.values = np.asarray(values, dtype=float)
+        self.errors = np.asarray(errors, dtype=float)
+        self.metadata = metadata or {}
+
+        shape = (len(QUANTITIES), len(self.r_nodes), len(self.z_nodes))
+        if self.values.shape != shape or self.errors.shape != shape:
+            raise ValueError("Efficiency map values do not match its grid.")
+        if np.any(np.diff(self.r_nodes) <= 0) or np.any(np.diff(self.z_nodes) <= 0):
+            raise ValueError("Efficiency map nodes must be increasing.")
+
+        # log of the positive quantities, floored so that empty nodes stay finite
+        tiny = np.finfo(float).tiny
+        self._tables = np.array([np.log(np.maximum(value, tiny)) if log else value
+                                 for value, log in zip(self.values, LOG_QUANTITIES)])
+
+    def lookup(self, positions, errors=False):
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+
+        # the crystal is a cylinder on the z axis, so only the distance from the axis and z matter
+        r = np.hypot(positions[:, 0], positions[:, 1])
+        z = positions[:, 2]
+
+        inside = ((r >= self.r_nodes[0]) & (r <= self.r_nodes[-1])
+                  & (z >= self.z_nodes[0]) & (z <= self.z_nodes[-1]))
+
+        i = np.clip(np.searchsorted(self.r_nodes, r, side='right') - 1, 0, len(self.r_nodes) - 2)
+        j = np.clip(np.searchsorted(self.z_nodes, z, side='right') - 1, 0, len(self.z_nodes) - 2)
+        u = np.clip((r - self.r_nodes[i]) / (self.r_nodes[i + 1] - self.r_nodes[i]), 0, 1)
+        v = np.clip((z - self.z_nodes[j]) / (self.z_nodes[j + 1] - self.z_nodes[j]), 0, 1)
+
+        def bilinear(table):
+            return ((1 - u) * (1 - v) * table[..., i, j] + u * (1 - v) * table[..., i + 1, j]
+                    + (1 - u) * v * table[..., i, j + 1] + u * v * table[..., i + 1, j + 1])
+
+        interpolated = bilinear(self._tables)
+        for k, log in enumerate(LOG_QUANTITIES):
+            if log:
+                interpolated[k] = np.exp(interpolated[k])
+        interpolated[:, ~inside] = np.nan
+
+        if not errors:
+            return tuple(interpolated)
+
+        interpolated_errors = bilinear(self.errors)
+        interpolated_errors[:, ~inside] = np.nan
+
+        return tuple(interpolated), tuple(interpolated_errors)
+
+    def save(self, path):
+        np.savez_compressed(path, r_nodes=self.r_nodes, z_nodes=self.z_nodes, values=self.values.astype(np.float32),
+                            errors=self.errors.astype(np.float32), metadata=np.array(json.dumps(self.metadata, sort_keys=True)))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(arrays['r_nodes'], arrays['z_nodes'], arrays['values'], arrays['errors'],
+                       json.loads(str(arrays['metadata'])))
+
+
+def _refine(nodes, log_values, relative_errors, axis, tolerance, min_spacing, max_new_nodes):
+    # how far each quantity changes beyond the tolerance over each interval, where the change is above its noise
+    change = np.abs(np.diff(log_values, axis=axis + 1))
+    noise = np.sqrt(np.take(relative_errors, range(1, nodes.size), axis=axis + 1)**2
+                    + np.take(relative_errors, range(nodes.size - 1), axis=axis + 1)**2)
+    excess = np.where(change > 3 * noise, np.maximum(change - tolerance, 0.), 0.)
+
+    # a new node is simulated at every node of the other axis, so an interval is scored by its steepness averaged
+    # over that whole axis rather than by its single steepest pair, and only the steepest few are split
+    score = excess.max(axis=0).mean(axis=1 - axis)
+    score[np.diff(nodes) <= 2 * min_spacing] = 0.
+
+    candidates = np.flatnonzero(score > 0)
+    chosen = np.sort(candidates[np.argsort(score[candidates])[::-1][:max_new_nodes]])
+
+    return (nodes[chosen] + nodes[chosen + 1]) / 2
+
+
+def build_efficiency_map(source_energy, detector_height, detector_radius, NaI_density, cross_sections_file_path,
+                         r_max, z_min, z_max, num_particles, initial_nodes=(6, 7), tolerance=0.15, max_refinements=4,
+                         min_spacing=0.05, max_nodes=2000, max_new_per_axis=2, workers=1, batch_size=rs.DEFAULT_BLOCK_SIZE,
+                         seed=None, source_sampling='cylinder'):
+
+    # the map is a tensor-product grid, which keeps the lookup a plain bilinear interpolation: refining splits whole
+    # rows and columns, at most max_new_per_axis of each per round, where the efficiencies change fastest on average
+
+    if r_max <= 0 or z_max <= z_min:
+        raise ValueError("The map needs r_max > 0 and z_max > z_min.")
+
+    # the crystal faces are nodes from the start, as the efficiencies bend sharply across them
+    r_nodes = np.union1d(np.linspace(0, r_max, initial_nodes[0]), [detector_radius] if detector_radius < r_max else [])
+    z_nodes = np.union1d(np.linspace(z_min, z_max, initial_nodes[1]),
+                         [z for z in (-detector_height / 2, detector_height / 2) if z_min < z < z_max])
+
+    # one shared seed, so neighbouring nodes are correlated and refinement follows the trend rather than the noise
+    seed_sequence = np.random.SeedSequence(seed)
+    computed = {}
+
+    def simulate(points):
+        configs = [{'source_position': np.array([r, 0., z]), 'source_energy': source_energy,
+                    'detector_height': detector_height, 'detector_radius': detector_radius} for r, z in points]
+        for result in sweeps.run_sweep(configs, NaI_density, num_particles, cross_sections_file_path, workers=workers,
+                                       batch_size=batch_size, seed=seed_sequence.entropy, source_sampling=source_sampling,
+                                       common_random_numbers=True):
+            computed[points[result['index']]] = _node_efficiencies(result)
+
+    def grid():
+        missing = [(r, z) for r in r_nodes for z in z_nodes if (r, z) not in computed]
+        if missing:
+            simulate(missing)
+
+        values = np.array([[computed[(r, z)][0] for z in z_nodes] for r in r_nodes]).transpose(2, 0, 1)
+        errors = np.array([[computed[(r, z)][1] for z in z_nodes] for r in r_nodes]).transpose(2, 0, 1)
+        return values, errors
+
+    values, errors = grid()
+
+    for _ in range(max_refinements):
+        log_values = np.log(np.maximum(values[[0, 2]], np.finfo(float).tiny))
+        relative_errors = errors[[0, 2]] / np.maximum(values[[0, 2]], np.finfo(float).tiny)
+
+        new_r = _refine(r_nodes, log_values, relative_errors, 0, tolerance, min_spacing, max_new_per_axis)
+        new_z = _refine(z_nodes, log_values, relative_errors, 1, tolerance, min_spacing, max_new_per_axis)
+
+        if not (new_r.size or new_z.size):
+            break
+        if (r_nodes.size + new_r.size) * (z_nodes.size + new_z.size) > max_nodes:
+            break
+
+        r_nodes = np.union1d(r_nodes, new_r)
+        z_nodes = np.union1d(z_nodes, new_z)
+        values, errors = grid()
+
+    metadata = {
+        'source_energy': source_energy,
+        'detector_height': detector_height,
+        'detector_radius': detector_radius,
+        'NaI_density': NaI_density,
+        'cross_sections': cf.file_hash(cross_sections_file_path),
+        'num_particles': num_particles,
+        'source_sampling': source_sampling,
+        'seed': {'entropy': str(seed_sequence.entropy)},
+    }
+
+    return EfficiencyMap(r_nodes, z_nodes, values, errors, metadata)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate an efficiency map over source positions around the crystal.')
+    parser.add_argument('output', help='npz file for the map')
+    parser.add_argument('--source-energy', type=float, required=True)
+    parser.add_argument('--detector-height', type=float, required=True)
+    parser.add_argument('--detector-radius', type=float, required=True)
+    parser.add_argument('--density', type=float, default=3.67)
+    parser.add_argument('--cross-sections', required=True)
+    parser.add_argument('--r-max', type=float, required=True)
+    parser.add_argument('--z-min', type=float, required=True)
+    parser.add_argument('--z-max', type=float, required=True)
+    parser.add_argument('--num-particles', type=int, default=100000)
+    parser.add_argument('--tolerance', type=float, default=0.15)
+    parser.add_argument('--max-new-per-axis', type=int, default=2, help='rows and columns of nodes added per refinement')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    efficiency_map = build_efficiency_map(args.source_energy, args.detector_height, args.detector_radius, args.density,
+                                          args.cross_sections, args.r_max, args.z_min, args.z_max, args.num_particles,
+                                          tolerance=args.tolerance, max_new_per_axis=args.max_new_per_axis, workers=args.workers,
+                                          seed=args.seed)
+    efficiency_map.save(args.output)
+    print(f"{len(efficiency_map.r_nodes)} x {len(efficiency_map.z_nodes)} nodes written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
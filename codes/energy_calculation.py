@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
 
 
 class EnergyHistogram:
@@ -8,29 +7,122 @@ class EnergyHistogram:
         self.energy_min = energy_min
         self.energy_max = energy_max
         self.bin_edges = np.linspace(energy_min, energy_max, num_bins + 1)
-        self.hist = np.zeros(num_bins, dtype=int)
-        self.energies = []
+        self.bin_width = (energy_max - energy_min) / num_bins
+        self.hist = np.zeros(num_bins)
 
-    def add(self, energies):
-        counts, _ = np.histogram(energies, bins=self.bin_edges)
-        self.hist += counts
-        self.energies.extend(energies)
+        # running sums over every added event, including the ones outside the binned range
+        self.count = 0
+        self.sum = 0.0
+        self.sum_of_squares = 0.0
+        self.underflow = 0
+        self.overflow = 0
+
+    def add(self, energies, weights=None):
+        energies = np.asarray(energies, dtype=float).ravel()
+        weights = np.ones_like(energies) if weights is None else np.asarray(weights, dtype=float).ravel()
+
+        index = np.floor((energies - self.energy_min) / self.bin_width).astype(np.int64)
+        index[energies == self.energy_max] = self.num_bins - 1
+
+        inside = (index >= 0) & (index < self.num_bins)
+        index, binned, binned_weights = index[inside], energies[inside], weights[inside]
+
+        # same edge convention as np.histogram when the arithmetic lands one bin off
+        index -= binned < self.bin_edges[index]
+        index += (binned >= self.bin_edges[index + 1]) & (index < self.num_bins - 1)
+
+        self.hist += np.bincount(index, weights=binned_weights, minlength=self.num_bins)
+        self.underflow += float(np.sum(weights[energies < self.energy_min]))
+        self.overflow += float(np.sum(weights[energies > self.energy_max]))
+
+        # sums of the weighted scores, so the efficiency errors hold for weighted histories as well
+        self.count += energies.size
+        self.sum += float(np.sum(weights * energies))
+        self.sum_of_squares += float(np.sum((weights * energies)**2))
+
+    def merge(self, other):
+        if (self.num_bins != other.num_bins or self.energy_min != other.energy_min
+                or self.energy_max != other.energy_max):
+            raise ValueError("Only histograms with the same binning can be merged.")
+
+        self.hist += other.hist
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_of_squares += other.sum_of_squares
+        self.underflow += other.underflow
+        self.overflow += other.overflow
+
+        return self
 
     def get_histogram(self):
         return self.hist, self.bin_edges
-    
-    def get_all_energies(self):
-        return np.array(self.energies)
-    
+
+    def to_arrays(self):
+        return {
+            'hist': self.hist,
+            'binning': np.array([self.num_bins, self.energy_min, self.energy_max], dtype=float),
+            'totals': np.array([self.count, self.sum, self.sum_of_squares, self.underflow, self.overflow], dtype=float),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        num_bins, energy_min, energy_max = arrays['binning']
+        histogram = cls(int(num_bins), float(energy_min), float(energy_max))
+
+        if len(arrays['hist']) != histogram.num_bins:
+            raise ValueError("Histogram counts do not match the stored binning.")
+
+        count, total, sum_of_squares, underflow, overflow = arrays['totals']
+        histogram.hist = np.array(arrays['hist'], dtype=histogram.hist.dtype)
+        histogram.count = int(count)
+        histogram.sum = float(total)
+        histogram.sum_of_squares = float(sum_of_squares)
+        histogram.underflow = float(underflow)
+        histogram.overflow = float(overflow)
+
+        return histogram
+
+    def save(self, path):
+        np.savez(path, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls.from_arrays(arrays)
+
 
 def total_energy_in_histogram(energy_histogram):
-    
-    energies = energy_histogram.get_all_energies()
 
-    return np.sum(energies)
+    return energy_histogram.sum
+
+
+def efficiency_relative_errors(energy_histogram, num_histories, num_reached):
+    S1 = energy_histogram.sum
+    S2 = energy_histogram.sum_of_squares
+
+    if S1 <= 0 or num_histories < 2:
+        return np.inf, np.inf
+
+    # efficiency_tot: mean deposit over all sampled histories
+    variance_tot = max(S2 / num_histories - (S1 / num_histories)**2, 0) / (num_histories - 1)
+    error_tot = np.sqrt(variance_tot) / (S1 / num_histories)
+
+    # efficiency_int: ratio estimator over the histories that reached the detector
+    variance_int = max(S2 - S1**2 / num_reached, 0) / num_reached**2
+    error_int = np.sqrt(variance_int) / (S1 / num_reached)
+
+    return error_tot, error_int
+
+
+def window_counts(energy_histogram, energy_low, energy_high):
+    hist, bin_edges = energy_histogram.get_histogram()
+    centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+
+    return float(np.sum(hist[(centers >= energy_low) & (centers < energy_high)]))
 
 
 def plot_energy_accumulator(energy_accumulator, title='Gamma Spectrum Monte Carlo Simulation', E_gamma = 0., save_path=None):
+    import matplotlib.pyplot as plt
 
     m_e = 0.511
 
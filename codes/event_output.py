@@ -0,0 +1,125 @@
+import os
+import json
+import shutil
+import numpy as np
+import energy_calculation as ec
+
+
+EVENT_DTYPE = np.dtype([
+    ('history', '<i8'),
+    ('deposit', '<f8'),
+    ('interactions', '<i4'),
+    ('pair', '?'),
+    ('first_position', '<f8', (3,)),
+    ('weight', '<f8'),
+])
+
+FORMAT_VERSION = 2
+
+
+def _sidecar_path(path):
+    return f"{path}.json"
+
+
+class EventSink:
+    def __init__(self, path, buffer_size=65536):
+        self.path = path
+        self.buffer = np.zeros(buffer_size, dtype=EVENT_DTYPE)
+        self.buffered = 0
+        self.num_events = 0
+
+        with open(_sidecar_path(path), 'w') as file:
+            json.dump({'format_version': FORMAT_VERSION, 'dtype': np.lib.format.dtype_to_descr(EVENT_DTYPE)}, file)
+
+        self._file = open(path, 'wb')
+
+    def append(self, history, deposit, interactions, pair, first_position, weight=None):
+        n = len(history)
+        start = 0
+
+        # copied into the fixed-size buffer, which goes to disk whenever it fills up
+        while start < n:
+            stop = min(n, start + len(self.buffer) - self.buffered)
+            block = self.buffer[self.buffered:self.buffered + stop - start]
+            block['history'] = history[start:stop]
+            block['deposit'] = deposit[start:stop]
+            block['interactions'] = interactions[start:stop]
+            block['pair'] = pair[start:stop]
+            block['first_position'] = first_position[start:stop]
+            block['weight'] = 1.0 if weight is None else weight[start:stop]
+
+            self.buffered += stop - start
+            start = stop
+            if self.buffered == len(self.buffer):
+                self.flush()
+
+        self.num_events += n
+
+    def append_file(self, path):
+        self.flush()
+
+        with open(path, 'rb') as part:
+            shutil.copyfileobj(part, self._file)
+
+        self.num_events += os.path.getsize(path) // EVENT_DTYPE.itemsize
+
+    def flush(self):
+        if self.buffered:
+            self._file.write(self.buffer[:self.buffered].tobytes())
+            self.buffered = 0
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class EventFile:
+    def __init__(self, path):
+        with open(_sidecar_path(path)) as file:
+            header = json.load(file)
+
+        if header['format_version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported event file version: {header['format_version']}")
+
+        self.path = path
+        self.dtype = np.lib.format.descr_to_dtype(header['dtype'])
+
+        size = os.path.getsize(path)
+        if size % self.dtype.itemsize:
+            raise ValueError("Event file does not hold a whole number of records.")
+
+        self.events = (np.memmap(path, dtype=self.dtype, mode='r') if size
+                       else np.zeros(0, dtype=self.dtype))
+
+    def __len__(self):
+        return len(self.events)
+
+    def chunks(self, chunk_size=1 << 20):
+        for start in range(0, len(self.events), chunk_size):
+            yield self.events[start:start + chunk_size]
+
+    def select(self, where, chunk_size=1 << 20):
+        # where maps a chunk of records to a boolean mask; only the selected records are copied
+        selected = [chunk[where(chunk)] for chunk in self.chunks(chunk_size)]
+
+        return np.concatenate(selected) if selected else np.zeros(0, dtype=self.dtype)
+
+    def histogram(self, num_bins=1024, energy_min=0., energy_max=None, where=None, chunk_size=1 << 20):
+        if energy_max is None:
+            energy_max = max((float(chunk['deposit'].max()) for chunk in self.chunks(chunk_size)), default=1.0)
+
+        energy_histogram = ec.EnergyHistogram(num_bins=num_bins, energy_min=energy_min, energy_max=energy_max)
+        for chunk in self.chunks(chunk_size):
+            if where is not None:
+                chunk = chunk[where(chunk)]
+            energy_histogram.add(chunk['deposit'], chunk['weight'])
+
+        return energy_histogram
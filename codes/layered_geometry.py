@@ -0,0 +1,272 @@
+import time
+import numpy as np
+import calculating_geometric_properties as cgp
+import energy_calculation as ec
+import compton_scattering as cs
+import source_sampling as ss
+import random_streams as rs
+import profiling as prof
+import transport_simulation as ts
+
+
+class Layer:
+    def __init__(self, name, table, radius, pztop, pzbottom, sensitive=False):
+        if radius <= 0 or pztop <= pzbottom:
+            raise ValueError(f"Layer {name} must have a positive radius and height.")
+
+        # table is None for a void, which photons cross without interacting
+        self.name = name
+        self.table = table
+        self.radius = radius
+        self.pztop = pztop
+        self.pzbottom = pzbottom
+        self.sensitive = sensitive
+
+
+class MajorantTable:
+    def __init__(self, tables, num_points=8192):
+        tables = [table for table in tables if table is not None]
+        if not tables:
+            raise ValueError("A geometry needs at least one material with cross sections.")
+
+        self.energy_min = min(table.energy_min for table in tables)
+        self.energy_max = max(table.energy_max for table in tables)
+        self.num_points = num_points
+
+        self.log_energy_min = np.log(self.energy_min)
+        self.log_step = (np.log(self.energy_max) - self.log_energy_min) / (num_points - 1)
+        grid = np.exp(self.log_energy_min + self.log_step * np.arange(num_points))
+
+        # piecewise constant, the largest total of any material anywhere in each interval; every table is linear
+        # in log(E) between its own nodes, so the maximum sits on an interval end or on one of those nodes
+        totals = np.max([table.lookup(grid)[3] for table in tables], axis=0)
+        self.values = np.maximum(totals[:-1], totals[1:])
+        for table in tables:
+            nodes = self._interval(table.grid)
+            np.maximum.at(self.values, nodes, table.values[3])
+
+    def _interval(self, energies):
+        x = (np.log(np.clip(energies, self.energy_min, self.energy_max)) - self.log_energy_min) / self.log_step
+        return np.minimum(x.astype(int), self.num_points - 2)
+
+    def lookup(self, energies):
+        energies = np.asarray(energies, dtype=float)
+        inside = (energies >= self.energy_min) & (energies <= self.energy_max)
+
+        return np.where(inside, self.values[self._interval(energies)], 0.0)
+
+
+class LayeredGeometry:
+    def __init__(self, layers):
+        # innermost first, every layer holding the ones before it
+        self.layers = list(layers)
+        if not self.layers:
+            raise ValueError("A geometry needs at least one layer.")
+
+        for inner, outer in zip(self.layers, self.layers[1:]):
+            if outer.radius < inner.radius or outer.pztop < inner.pztop or outer.pzbottom > inner.pzbottom:
+                raise ValueError(f"Layer {outer.name} does not enclose layer {inner.name}.")
+
+        if not any(layer.sensitive for layer in self.layers):
+            raise ValueError("A geometry needs at least one sensitive layer.")
+
+        self.radii = np.array([layer.radius for layer in self.layers])
+        self.pztops = np.array([layer.pztop for layer in self.layers])
+        self.pzbottoms = np.array([layer.pzbottom for layer in self.layers])
+        self.sensitive = np.array([layer.sensitive for layer in self.layers] + [False])
+
+        self.majorant = MajorantTable([layer.table for layer in self.layers])
+
+        world = self.layers[-1]
+        self.pztop, self.pzbottom, self.radius = world.pztop, world.pzbottom, world.radius
+
+        crystal = self.layers[np.flatnonzero(self.sensitive)[-1]]
+        self.crystal = (crystal.pztop, crystal.pzbottom, crystal.radius)
+
+    def region(self, positions):
+        r2 = positions[:, 0]**2 + positions[:, 1]**2
+        z = positions[:, 2]
+
+        # index of the innermost layer holding each point, len(layers) outside the world
+        region = np.full(len(positions), len(self.layers))
+        for k in reversed(range(len(self.layers))):
+            inside = (r2 <= self.radii[k]**2) & (z <= self.pztops[k]) & (z >= self.pzbottoms[k])
+            region[inside] = k
+
+        return region
+
+    def lookup(self, region, energies):
+        values = np.zeros((4, len(energies)))
+        for k, layer in enumerate(self.layers):
+            chosen = region == k
+            if layer.table is not None and chosen.any():
+                values[:, chosen] = layer.table.lookup(energies[chosen])
+
+        return values
+
+
+def make_detector_geometry(detector_height, detector_radius, crystal_table, shells=()):
+    layers = [Layer('NaI', crystal_table, detector_radius, detector_height / 2, -detector_height / 2, sensitive=True)]
+
+    # every shell adds its thicknesses to the outside of the layer before it
+    for shell in shells:
+        side, top, bottom = (shell.get(face, 0.) for face in ('side', 'top', 'bottom'))
+        if min(side, top, bottom) < 0:
+            raise ValueError(f"Shell {shell['name']} has a negative thickness.")
+
+        inner = layers[-1]
+        layers.append(Layer(shell['name'], shell.get('table'), inner.radius + side, inner.pztop + top, inner.pzbottom - bottom,
+                            sensitive=shell.get('sensitive', False)))
+
+    return LayeredGeometry(layers)
+
+
+def transport_photons(positions, directions, energies, geometry, rng):
+    stats = prof.active()
+
+    summing_energy = np.zeros(len(energies))
+
+    stack = ts.ParticleStack()
+    history = np.arange(len(energies))
+    positions = np.array(positions, dtype=float)
+    directions = np.array(directions, dtype=float)
+    energies = np.array(energies, dtype=float)
+
+    while history.size:
+
+        # delta tracking: flights are sampled with the majorant, so no step looks for a surface
+        majorant = geometry.majorant.lookup(energies)
+
+        alive = (energies > 0.001) & (majorant > 0)
+        lambd = -np.log(rng.random(history.size)) / np.where(alive, majorant, 1.0)
+        positions = positions + directions * lambd[:, None]
+
+        # the world is convex and holds everything, so a photon that leaves it never comes back
+        region = geometry.region(positions)
+        escaped = alive & (region == len(geometry.layers))
+
+        if stats is not None:
+            stats.count('steps', np.count_nonzero(alive))
+            stats.count('escapes', np.count_nonzero(escaped))
+
+        alive &= ~escaped
+
+        history, positions, directions, energies = history[alive], positions[alive], directions[alive], energies[alive]
+        majorant, region = majorant[alive], region[alive]
+
+        compton, photo, pair, total = geometry.lookup(region, energies)
+
+        # the gap between the local total and the majorant is a fictitious collision that changes nothing
+        rand = rng.random(history.size) * majorant
+        compton_scatter = rand < compton
+        photoelectric_absorb = ~compton_scatter & (rand < compton + photo)
+        pair_production = ~compton_scatter & ~photoelectric_absorb & (rand < total) & (energies > 1.022)
+        sensitive = geometry.sensitive[region]
+
+        if stats is not None:
+            stats.count('fictitious', np.count_nonzero(rand >= total))
+            stats.count('compton', np.count_nonzero(compton_scatter))
+            stats.count('photoelectric', np.count_nonzero(photoelectric_absorb))
+            stats.count('pair_production', np.count_nonzero(pair_production))
+
+        # only collisions in the sensitive volume add to the pulse height
+        absorbed = photoelectric_absorb & sensitive
+        np.add.at(summing_energy, history[absorbed], energies[absorbed])
+
+        if pair_production.any():
+            deposited = pair_production & sensitive
+            np.add.at(summing_energy, history[deposited], energies[deposited] - 1.022)
+            ts.push_annihilation_photons(stack, history[pair_production], positions[pair_production], rng)
+
+        if compton_scatter.any():
+            directions[compton_scatter], energies[compton_scatter], deposited = cs.compton_scatter_photons(
+                energies[compton_scatter], directions[compton_scatter], rng)
+            np.add.at(summing_energy, history[compton_scatter], np.where(sensitive[compton_scatter], deposited, 0.0))
+
+        alive = ~photoelectric_absorb & ~pair_production
+        history, positions, directions, energies = history[alive], positions[alive], directions[alive], energies[alive]
+
+        if len(stack):
+            secondaries = stack.pop_all()
+            history, positions, directions, energies = (np.concatenate([live, secondary]) for live, secondary
+                                                        in zip((history, positions, directions, energies), secondaries))
+
+    return summing_energy
+
+
+def simulate_transport_batch(source_position, source_energy, geometry, num_photons, source_sampler, streams,
+                             first_history=0, energy_max=None):
+
+    if energy_max is None:
+        energy_max = 1.1 * source_energy
+
+    energy_accumulator = ec.EnergyHistogram(num_bins=ts.RAW_SPECTRUM_BINS, energy_min=0., energy_max=energy_max)
+
+    reached_detector_num = 0
+
+    for block, start, stop in streams.blocks(first_history, num_photons):
+        n = stop - start
+        rng = streams.block_generator(block)
+
+        with prof.stage('source_sampling'):
+            directions = source_sampler.sample(n, rng)
+        sources = np.tile(np.asarray(source_position, dtype=float), (n, 1))
+
+        # photons start on the outside of the world, or at the source when it sits inside it
+        positions, entered = cgp.intersect_cylinder_starting_points_batch(sources, directions, geometry.pztop,
+                                                                          geometry.pzbottom, geometry.radius)
+
+        # efficiency_int keeps its meaning: the energy of the photons aimed at the crystal itself
+        reached = np.isfinite(cgp.intersect_cylinder_out_batch(sources, directions, *geometry.crystal))
+        reached_detector_num += np.count_nonzero(reached)
+
+        stats = prof.active()
+        if stats is not None:
+            stats.count('histories', n)
+            stats.count('reached', np.count_nonzero(reached))
+
+        summing_energy = transport_photons(positions, directions[entered], np.full(len(positions), float(source_energy)),
+                                           geometry, rng)
+
+        with prof.stage('tally'):
+            energy_accumulator.add(summing_energy[summing_energy > 0])
+
+    E_int = reached_detector_num * source_energy
+
+    return energy_accumulator, E_int
+
+
+def record_gamma_spectrum(source_position, source_energy, geometry, FWHM, num_particles, batch_size=rs.DEFAULT_BLOCK_SIZE,
+                          workers=1, seed=None, resolution_model='proportional', source_sampling='cylinder', profile=False):
+
+    if workers < 1:
+        raise ValueError("Number of workers must be at least 1.")
+
+    start_time = time.perf_counter()
+
+    with prof.collecting(prof.TransportStats() if profile else None) as stats:
+
+        with prof.stage('setup'):
+            # directions are sampled towards the whole assembly, so photons can reach the crystal through the shells
+            if source_sampling == 'cylinder':
+                source_sampler = ss.CylinderSourceSampler(source_position, geometry.pztop, geometry.pzbottom, geometry.radius)
+            elif geometry.pztop == -geometry.pzbottom:
+                source_sampler = ss.make_source_sampler(source_position, 2 * geometry.pztop, geometry.radius, source_sampling)
+            else:
+                raise ValueError("Cone sampling needs a geometry centred on z = 0.")
+
+        streams = rs.RandomStreams(seed, block_size=batch_size)
+
+        # the chunking, worker pool and merging are the plain engine's; only the block loop is this module's
+        energy_accumulator, E_int = ts.simulate_in_chunks(simulate_transport_batch, (source_position, source_energy, geometry),
+                                                          num_particles, source_sampler, streams, workers=workers)
+
+        energy_accumulator, efficiency_tot, efficiency_int = ts.spectrum_efficiencies(energy_accumulator, E_int, source_sampler,
+                                                                                      num_particles, source_energy, FWHM,
+                                                                                      resolution_model)
+
+    if profile:
+        stats.wall_time = time.perf_counter() - start_time
+        return energy_accumulator, efficiency_tot, efficiency_int, stats
+
+    return energy_accumulator, efficiency_tot, efficiency_int
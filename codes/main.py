@@ -1,9 +1,11 @@
+import os
 import numpy as np
-import matplotlib.pyplot as plt
 from energy_calculation import plot_energy_accumulator
 from transport_simulation import record_gamma_spectrum
+from sweeps import make_grid, run_sweep
 
 def plot_geometries(positions, detector_height, detector_radius, save_path=None):
+    import matplotlib.pyplot as plt
 
     fig = plt.figure(figsize=(8, 6))
     ax = fig.add_subplot(111, projection='3d')
@@ -30,6 +32,8 @@ def plot_geometries(positions, detector_height, detector_radius, save_path=None)
 
 
 def main():
+    import matplotlib.pyplot as plt
+
     source_A = np.array([3.0, -3.0, 2.0])
     source_B = np.array([4.0, 4.0, 0.0])
     energy_A = 0.6617  # MeV
@@ -52,14 +56,15 @@ def main():
     plot_energy_accumulator(energy_acc_B, f'Gamma Spectrum ({energy_B} MeV)', energy_B, save_path=r'D:\Egyetem\Monte Carlo\Monte_Carlo_final_project\plots_and_data\energy_spectrum_B.png')
     print(f"Spectrum B ({energy_B} MeV): η_tot =", eff_tot_B, "η_int =", eff_int_B)
 
+    workers = os.cpu_count() or 1
+
     positions = np.linspace([1.0, 3.5, 2.0], [-4.0, -1.5, 2.0], 11)
-    effs_tot = []
-    effs_int = []
+    effs_tot = np.zeros(len(positions))
+    effs_int = np.zeros(len(positions))
 
-    for pos in positions:
-        _, eff_tot, eff_int = record_gamma_spectrum(pos, energy_A, height_A, radius_A, density, FWHM_A, num_particles, cross_sections_file_path=cross_sections_file_path)
-        effs_tot.append(eff_tot)
-        effs_int.append(eff_int)
+    for result in run_sweep(make_grid(positions, [energy_A], [height_A], [radius_A], [FWHM_A]), density, num_particles, cross_sections_file_path, workers=workers, common_random_numbers=True):
+        effs_tot[result['index']] = result['efficiency_tot']
+        effs_int[result['index']] = result['efficiency_int']
 
 
     plot_geometries(positions, height_A, radius_A, save_path=r'D:\Egyetem\Monte Carlo\Monte_Carlo_final_project\plots_and_data\detector_geometry.png')
@@ -77,13 +82,12 @@ def main():
 
 
     energies = np.linspace(0.4, 4.0, 10)
-    effs_tot_B = []
-    effs_int_B = []
+    effs_tot_B = np.zeros(len(energies))
+    effs_int_B = np.zeros(len(energies))
 
-    for E in energies:
-        _, eff_tot, eff_int = record_gamma_spectrum(source_B, E, height_B, radius_B, density, FWHM_B, num_particles, cross_sections_file_path=cross_sections_file_path)
-        effs_tot_B.append(eff_tot)
-        effs_int_B.append(eff_int)
+    for result in run_sweep(make_grid([source_B], energies, [height_B], [radius_B], [FWHM_B]), density, num_particles, cross_sections_file_path, workers=workers, common_random_numbers=True):
+        effs_tot_B[result['index']] = result['efficiency_tot']
+        effs_int_B[result['index']] = result['efficiency_int']
 
     plt.figure()
     plt.plot(energies, effs_tot_B, label=r'$η_{tot}$')
@@ -1,4 +1,5 @@
 import numpy as np
+import profiling as prof
 
 
 def transform_direction(direction, axis):
@@ -22,16 +23,17 @@ def transform_direction(direction, axis):
     return R @ direction
 
 
-def isotropic_direction_in_angle(angle):
-    
+@prof.timed('direction_sampling')
+def isotropic_direction_in_angle(angle, rng):
+
     if angle < 0 or angle > np.pi:
         raise ValueError("Angle must be between 0 and pi radians.")
     
     n = np.zeros(3)
-    n[2] = np.random.rand()*(1 - np.cos(angle)) + np.cos(angle)
+    n[2] = rng.random()*(1 - np.cos(angle)) + np.cos(angle)
 
     theta = np.arccos(n[2])
-    beta = 2 * np.pi * np.random.rand()
+    beta = 2 * np.pi * rng.random()
 
     n[0] = np.sin(theta) * np.cos(beta)
     n[1] = np.sin(theta) * np.sin(beta)
@@ -40,38 +42,62 @@ def isotropic_direction_in_angle(angle):
     return n
 
 
-def isotropic_direction_in_cone(angle, source_position, detector_height, detector_radius):
+def isotropic_direction_in_cone(angle, source_position, detector_height, detector_radius, rng):
     axis = -source_position / np.linalg.norm(source_position)
 
     if np.sqrt(detector_radius**2 + detector_height**2 / 4) >= np.linalg.norm(source_position):
-        n = isotropic_direction_in_angle(np.pi)
+        n = isotropic_direction_in_angle(np.pi, rng)
 
     else:
-        n = isotropic_direction_in_angle(angle)
+        n = isotropic_direction_in_angle(angle, rng)
         n = transform_direction(n, axis)
         
     return n
 
 
-def photon_angle(energy_in):
+@prof.timed('direction_sampling')
+def isotropic_directions_in_angle(angle, num_directions, rng):
+
+    if angle < 0 or angle > np.pi:
+        raise ValueError("Angle must be between 0 and pi radians.")
+
+    cos_theta = rng.random(num_directions) * (1 - np.cos(angle)) + np.cos(angle)
+    sin_theta = np.sqrt(1 - cos_theta**2)
+    beta = 2 * np.pi * rng.random(num_directions)
+
+    return np.column_stack([sin_theta * np.cos(beta), sin_theta * np.sin(beta), cos_theta])
+
+
+def isotropic_directions_in_cone(angle, source_position, detector_height, detector_radius, num_directions, rng):
+    axis = -source_position / np.linalg.norm(source_position)
+
+    if np.sqrt(detector_radius**2 + detector_height**2 / 4) >= np.linalg.norm(source_position):
+        return isotropic_directions_in_angle(np.pi, num_directions, rng)
+
+    n = isotropic_directions_in_angle(angle, num_directions, rng)
+
+    return transform_direction(n.T, axis).T
+
+
+def photon_angle(energy_in, rng):
     alpha = energy_in / 0.511  
     
     while True:
 
         epsilon = 1 + 2*alpha  # Maximum energy ratio (for backscatter)
-        r1, r2 = np.random.rand(2)
+        r1, r2 = rng.random(2)
         
-        if r1 < (alpha + 1)/(9*alpha + 1):
+        if r1 <= (1 + 2*alpha)/(9 + 2*alpha):
             # Sample from high-acceptance region
             epsilon = 1 + 2*alpha*r2
-            g = (1 + 2*alpha/epsilon + (1/epsilon)**2)/4
+            g = 4*(1/epsilon - 1/epsilon**2)
         else:
             # Sample from low-rejection region
             epsilon = (1 + 2*alpha)/(1 + 2*alpha*r2)
-            g = (epsilon + 1/epsilon - (1 - ((epsilon - 1)/(alpha*epsilon))**2)/2)
+            g = ((1 - (epsilon - 1)/alpha)**2 + 1/epsilon)/2
         
         # Acceptance test
-        if np.random.rand() <= g:
+        if rng.random() <= g:
             break
     
     costheta = 1 - (epsilon - 1)/alpha
@@ -81,13 +107,13 @@ def photon_angle(energy_in):
     return theta, energy_out
 
 
-def photon_direction(angle):
+def photon_direction(angle, rng):
 
     n = np.zeros(3)
     n[2] = np.cos(angle)
 
     rho = np.sin(angle)
-    phi = np.random.rand() * 2 * np.pi
+    phi = rng.random() * 2 * np.pi
 
     n[0] = rho * np.cos(phi)
     n[1] = rho * np.sin(phi)
@@ -95,10 +121,11 @@ def photon_direction(angle):
     return n
 
 
-def compton_scatter_photon(energy_in, direction):
+@prof.timed('compton_sampling')
+def compton_scatter_photon(energy_in, direction, rng):
     
-    angle, energy_out = photon_angle(energy_in)
-    direction_around_z = photon_direction(angle)
+    angle, energy_out = photon_angle(energy_in, rng)
+    direction_around_z = photon_direction(angle, rng)
 
     direction = transform_direction(direction_around_z, direction)
 
@@ -0,0 +1,221 @@
+import math
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+NUMBA_AVAILABLE = numba is not None
+
+_GOLDEN_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_MIX_1 = np.uint64(0xBF58476D1CE4E5B9)
+_MIX_2 = np.uint64(0x94D049BB133111EB)
+
+
+def _njit(**options):
+    if numba is None:
+        return lambda function: function
+    return numba.njit(**options)
+
+
+prange = numba.prange if numba is not None else range
+
+
+def set_num_threads(num_threads):
+    if numba is not None:
+        numba.set_num_threads(max(1, min(num_threads, numba.config.NUMBA_NUM_THREADS)))
+
+
+@_njit(cache=True)
+def _mix(z):
+    z = (z ^ (z >> np.uint64(30))) * _MIX_1
+    z = (z ^ (z >> np.uint64(27))) * _MIX_2
+    return z ^ (z >> np.uint64(31))
+
+
+@_njit(cache=True)
+def _uniform(state):
+    # splitmix64; every history has its own state, so threads and chunks never share a stream
+    state = state + _GOLDEN_GAMMA
+    return state, (_mix(state) >> np.uint64(11)) * (1.0 / 9007199254740992.0)
+
+
+@_njit(cache=True)
+def _lookup(energy, values, log_energy_min, log_step, energy_min, energy_max):
+    if energy < energy_min or energy > energy_max:
+        return 0.0, 0.0, 0.0, 0.0
+
+    x = (math.log(energy) - log_energy_min) / log_step
+    index = min(int(x), values.shape[1] - 2)
+    fraction = x - index
+
+    return (values[0, index] * (1 - fraction) + values[0, index + 1] * fraction,
+            values[1, index] * (1 - fraction) + values[1, index + 1] * fraction,
+            values[2, index] * (1 - fraction) + values[2, index + 1] * fraction,
+            values[3, index] * (1 - fraction) + values[3, index + 1] * fraction)
+
+
+@_njit(cache=True)
+def _distance_out(px, py, pz, ux, uy, uz, pztop, pzbottom, radius):
+    # same chord as cgp.intersect_cylinder_in_batch, for one ray
+    a = ux * ux + uy * uy
+    b = px * ux + py * uy
+    c = px * px + py * py - radius * radius
+
+    if a < 1e-14:
+        if c <= 0:
+            t_near, t_far = -np.inf, np.inf
+        else:
+            t_near, t_far = np.inf, -np.inf
+    else:
+        d = b * b - a * c
+        if d < 0:
+            t_near, t_far = np.inf, -np.inf
+        else:
+            q = -(b + math.copysign(math.sqrt(d), b))
+            root_a = q / a
+            root_b = c / q if q != 0 else root_a
+            t_near, t_far = min(root_a, root_b), max(root_a, root_b)
+
+    if abs(uz) < 1e-14:
+        if pzbottom <= pz <= pztop:
+            s_near, s_far = -np.inf, np.inf
+        else:
+            s_near, s_far = np.inf, -np.inf
+    else:
+        d_plus = (pztop - pz) / uz
+        d_minus = (pzbottom - pz) / uz
+        s_near, s_far = min(d_plus, d_minus), max(d_plus, d_minus)
+
+    t_near = max(t_near, s_near)
+    t_far = min(t_far, s_far)
+
+    return max(t_far, 0.0) if t_near <= t_far else 0.0
+
+
+@_njit(cache=True)
+def _klein_nishina(energy, state):
+    alpha = energy / 0.511
+
+    # Kahn's rejection method, as in cs.sample_klein_nishina
+    while True:
+        state, r1 = _uniform(state)
+        state, r2 = _uniform(state)
+        state, r3 = _uniform(state)
+
+        if r1 <= (1 + 2 * alpha) / (9 + 2 * alpha):
+            epsilon = 1 + 2 * alpha * r2
+            g = 4 * (1 / epsilon - 1 / epsilon**2)
+        else:
+            epsilon = (1 + 2 * alpha) / (1 + 2 * alpha * r2)
+            costheta = 1 - (epsilon - 1) / alpha
+            g = (costheta**2 + 1 / epsilon) / 2
+
+        if r3 <= g:
+            break
+
+    costheta = min(max(1 - (epsilon - 1) / alpha, -1.0), 1.0)
+    return state, costheta, energy / epsilon
+
+
+@_njit(cache=True)
+def _rotate(ux, uy, uz, costheta, phi):
+    # same rotation as cs.rotate_directions, for one direction
+    sintheta = math.sqrt(max(1 - costheta**2, 0.0))
+    cosphi = math.cos(phi)
+    sinphi = math.sin(phi)
+    perp = math.sqrt(max(1 - uz**2, 0.0))
+
+    if perp < 1e-8:
+        return sintheta * cosphi, sintheta * sinphi, math.copysign(1.0, uz) * costheta
+
+    return (sintheta * (ux * uz * cosphi - uy * sinphi) / perp + ux * costheta,
+            sintheta * (uy * uz * cosphi + ux * sinphi) / perp + uy * costheta,
+            uz * costheta - sintheta * cosphi * perp)
+
+
+@_njit(cache=True)
+def _history(px, py, pz, ux, uy, uz, energy, state, values, log_energy_min, log_step, energy_min, energy_max,
+             pztop, pzbottom, radius):
+    deposit = 0.0
+
+    # a pair leaves at most two annihilation photons, and at 0.511 MeV they cannot make another pair
+    pending = 0
+    ax = ay = az = dx = dy = dz = 0.0
+
+    while True:
+        while energy > 0.001:
+            compton, photo, pair, total = _lookup(energy, values, log_energy_min, log_step, energy_min, energy_max)
+            if total <= 0:
+                break
+
+            state, u = _uniform(state)
+            lambd = -math.log(u) / total if u > 0 else np.inf
+
+            if _distance_out(px, py, pz, ux, uy, uz, pztop, pzbottom, radius) < lambd:
+                break
+
+            px += ux * lambd
+            py += uy * lambd
+            pz += uz * lambd
+
+            state, u = _uniform(state)
+            rand = u * total
+
+            if rand < compton:
+                state, costheta, energy_out = _klein_nishina(energy, state)
+                state, u = _uniform(state)
+                ux, uy, uz = _rotate(ux, uy, uz, costheta, 2 * np.pi * u)
+                deposit += energy - energy_out
+                energy = energy_out
+
+            elif rand < compton + photo:
+                deposit += energy
+                energy = 0.0
+
+            elif energy > 1.022:
+                deposit += energy - 1.022
+                energy = 0.0
+
+                state, u = _uniform(state)
+                state, v = _uniform(state)
+                cos_polar = 2 * u - 1
+                sin_polar = math.sqrt(max(1 - cos_polar**2, 0.0))
+                dx, dy, dz = sin_polar * math.cos(2 * np.pi * v), sin_polar * math.sin(2 * np.pi * v), cos_polar
+                ax, ay, az = px, py, pz
+                pending = 2
+
+        if pending == 0:
+            return deposit
+
+        # the two annihilation photons leave back to back
+        sign = 1.0 if pending == 2 else -1.0
+        pending -= 1
+        px, py, pz = ax, ay, az
+        ux, uy, uz = sign * dx, sign * dy, sign * dz
+        energy = 0.511
+
+
+@_njit(parallel=True, cache=True)
+def transport_histories(positions, directions, history_ids, source_energy, values, log_energy_min, log_step,
+                        energy_min, energy_max, pztop, pzbottom, radius, key_0, key_1):
+    n = positions.shape[0]
+    deposits = np.zeros(n)
+
+    for k in prange(n):
+        state = _mix(key_0 ^ _mix(key_1 ^ _mix(np.uint64(history_ids[k]))))
+        deposits[k] = _history(positions[k, 0], positions[k, 1], positions[k, 2],
+                               directions[k, 0], directions[k, 1], directions[k, 2], source_energy, state,
+                               values, log_energy_min, log_step, energy_min, energy_max, pztop, pzbottom, radius)
+
+    return deposits
+
+
+def transport_photons(positions, directions, history_ids, source_energy, cross_section_table, pztop, pzbottom, radius, streams):
+    return transport_histories(np.ascontiguousarray(positions, dtype=float), np.ascontiguousarray(directions, dtype=float),
+                               np.asarray(history_ids, dtype=np.int64), float(source_energy), cross_section_table.values,
+                               float(cross_section_table.log_energy_min), float(cross_section_table.log_step),
+                               float(cross_section_table.energy_min), float(cross_section_table.energy_max),
+                               float(pztop), float(pzbottom), float(radius), np.uint64(streams.key[0]), np.uint64(streams.key[1]))
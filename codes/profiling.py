@@ -0,0 +1,126 @@
+import json
+import time
+import functools
+from contextlib import contextmanager
+
+
+_active = None
+
+
+class TransportStats:
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self.calls = {}
+        self.wall_time = 0.
+        self._stage = None
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def add_time(self, stage, seconds, calls=1):
+        self.timers[stage] = self.timers.get(stage, 0.) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + calls
+
+    def merge(self, other):
+        for name, n in other.counters.items():
+            self.count(name, n)
+        for stage, seconds in other.timers.items():
+            self.add_time(stage, seconds, other.calls.get(stage, 0))
+
+        return self
+
+    def derived(self):
+        counters = self.counters
+        reached = counters.get('reached', 0)
+        tracked = reached + counters.get('secondaries', 0)
+        interactions = counters.get('compton', 0) + counters.get('photoelectric', 0) + counters.get('pair_production', 0)
+
+        def ratio(a, b):
+            return a / b if b else None
+
+        return {
+            'steps_per_history': ratio(counters.get('steps', 0), reached),
+            'escape_fraction': ratio(counters.get('escapes', 0), tracked),
+            'reached_fraction': ratio(reached, counters.get('histories', 0)),
+            'compton_fraction': ratio(counters.get('compton', 0), interactions),
+            'photoelectric_fraction': ratio(counters.get('photoelectric', 0), interactions),
+            'pair_production_fraction': ratio(counters.get('pair_production', 0), interactions),
+            'histories_per_second': ratio(counters.get('histories', 0), self.wall_time),
+        }
+
+    def to_dict(self):
+        return {
+            'wall_time': self.wall_time,
+            'counters': dict(self.counters),
+            'timers': {stage: {'seconds': seconds, 'calls': self.calls.get(stage, 0)}
+                       for stage, seconds in self.timers.items()},
+            'derived': self.derived(),
+        }
+
+    def to_json(self, path=None, indent=2):
+        text = json.dumps(self.to_dict(), indent=indent)
+
+        if path is not None:
+            with open(path, 'w') as file:
+                file.write(text)
+
+        return text
+
+
+def active():
+    return _active
+
+
+@contextmanager
+def collecting(stats):
+    global _active
+
+    if stats is None:
+        yield _active
+        return
+
+    previous, _active = _active, stats
+    try:
+        yield stats
+    finally:
+        _active = previous
+
+
+@contextmanager
+def stage(name):
+    stats = _active
+
+    # stages do not nest, time goes to the outermost one so the stage times add up
+    if stats is None or stats._stage is not None:
+        yield
+        return
+
+    stats._stage = name
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add_time(name, time.perf_counter() - start)
+        stats._stage = None
+
+
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            stats = _active
+            if stats is None or stats._stage is not None:
+                return function(*args, **kwargs)
+
+            stats._stage = name
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.add_time(name, time.perf_counter() - start)
+                stats._stage = None
+
+        return wrapper
+
+    return decorator
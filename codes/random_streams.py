@@ -0,0 +1,89 @@
+import numpy as np
+
+
+DEFAULT_BLOCK_SIZE = 8192
+
+_BLOCK_STREAM = 0
+_HISTORY_STREAM = 1
+
+
+class BufferedGenerator:
+    def __init__(self, generator, buffer_size=256):
+        self.generator = generator
+        self.buffer_size = buffer_size
+        self._uniforms = []
+        self._next_uniform = 0
+        self._normals = []
+        self._next_normal = 0
+
+    def _take(self, values, position, draw, size):
+        n = 1 if size is None else int(np.prod(size))
+
+        if position + n > len(values):
+            values = values[position:] + draw(max(self.buffer_size, n)).tolist()
+            position = 0
+
+        if size is None:
+            return values, position + 1, values[position]
+
+        return values, position + n, np.array(values[position:position + n]).reshape(size)
+
+    def random(self, size=None):
+        self._uniforms, self._next_uniform, value = self._take(self._uniforms, self._next_uniform,
+                                                               self.generator.random, size)
+        return value
+
+    def normal(self, loc=0.0, scale=1.0, size=None):
+        self._normals, self._next_normal, value = self._take(self._normals, self._next_normal,
+                                                             self.generator.standard_normal, size)
+        return loc + scale * value
+
+
+class RandomStreams:
+    def __init__(self, seed=None, block_size=DEFAULT_BLOCK_SIZE):
+        if block_size < 1:
+            raise ValueError("Block size must be at least 1.")
+
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.key = self.seed_sequence.generate_state(2, dtype=np.uint64)
+        self.block_size = block_size
+
+    def _generator(self, kind, index):
+        # the lowest counter word advances while drawing, the upper words address the stream
+        counter = np.array([0, index, kind, 0], dtype=np.uint64)
+        return np.random.Generator(np.random.Philox(counter=counter, key=self.key))
+
+    def block_generator(self, block):
+        return self._generator(_BLOCK_STREAM, block)
+
+    def history_generator(self, history, buffer_size=256):
+        return BufferedGenerator(self._generator(_HISTORY_STREAM, history), buffer_size)
+
+    def blocks(self, first_history, num_histories):
+        # a block's draws depend on all of its histories, so a range that starts inside one cannot reproduce it
+        if first_history % self.block_size:
+            raise ValueError("Block ranges must start on a block boundary.")
+
+        end = first_history + num_histories
+        start = first_history
+
+        while start < end:
+            block = start // self.block_size
+            stop = min((block + 1) * self.block_size, end)
+            yield block, start, stop
+            start = stop
+
+    def split(self, num_histories, num_chunks):
+        # chunk boundaries on block boundaries, so every block is drawn by exactly one chunk
+        num_blocks = -(-num_histories // self.block_size)
+        blocks_per_chunk = [num_blocks // num_chunks + (1 if i < num_blocks % num_chunks else 0) for i in range(num_chunks)]
+
+        chunks = []
+        first_history = 0
+        for num_chunk_blocks in blocks_per_chunk:
+            last_history = min(first_history + num_chunk_blocks * self.block_size, num_histories)
+            if last_history > first_history:
+                chunks.append((first_history, last_history - first_history))
+            first_history = last_history
+
+        return chunks or [(0, 0)]
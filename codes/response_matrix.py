@@ -0,0 +1,153 @@
+import json
+import numpy as np
+import cross_sections_data as csd
+import detector_resolution as dr
+import energy_calculation as ec
+import random_streams as rs
+import source_sampling as ss
+import transport_simulation as ts
+
+
+class ResponseMatrix:
+    def __init__(self, incident_energies, matrix, energy_max, efficiencies_tot=None, efficiencies_int=None, metadata=None):
+        self.incident_energies = np.asarray(incident_energies, dtype=float)
+        self.matrix = matrix
+        self.energy_max = float(energy_max)
+        self.num_bins = matrix.shape[1]
+        self.bin_edges = np.linspace(0., self.energy_max, self.num_bins + 1)
+        self.efficiencies_tot = None if efficiencies_tot is None else np.asarray(efficiencies_tot, dtype=float)
+        self.efficiencies_int = None if efficiencies_int is None else np.asarray(efficiencies_int, dtype=float)
+        self.metadata = metadata or {}
+
+        if matrix.shape[0] != len(self.incident_energies):
+            raise ValueError("The response matrix needs one row per incident energy.")
+        if np.any(np.diff(self.incident_energies) <= 0):
+            raise ValueError("Incident energies must be strictly increasing.")
+
+    def save(self, path):
+        np.save(path + '.npy', np.ascontiguousarray(self.matrix, dtype=np.float32))
+
+        header = {
+            'incident_energies': self.incident_energies.tolist(),
+            'energy_max': self.energy_max,
+            'efficiencies_tot': None if self.efficiencies_tot is None else self.efficiencies_tot.tolist(),
+            'efficiencies_int': None if self.efficiencies_int is None else self.efficiencies_int.tolist(),
+            'metadata': self.metadata,
+        }
+        with open(path + '.json', 'w') as file:
+            json.dump(header, file, indent=2)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        with open(path + '.json', 'r') as file:
+            header = json.load(file)
+
+        matrix = np.load(path + '.npy', mmap_mode=mmap_mode)
+
+        return cls(header['incident_energies'], matrix, header['energy_max'],
+                   header['efficiencies_tot'], header['efficiencies_int'], header['metadata'])
+
+    def response(self, energy):
+        energies = self.incident_energies
+        if energy < energies[0] or energy > energies[-1]:
+            raise ValueError(f"Energy {energy} MeV is outside the simulated range [{energies[0]}, {energies[-1]}] MeV.")
+
+        k = min(np.searchsorted(energies, energy, side='right') - 1, len(energies) - 2)
+        weight = (energy - energies[k]) / (energies[k + 1] - energies[k])
+
+        # blend the two neighbouring rows on the deposited-energy axis scaled by the incident energy,
+        # so the photopeak and the Compton edge move with the energy instead of splitting in two
+        cumulative = np.zeros(self.num_bins + 1)
+        for row, row_weight in ((k, 1 - weight), (k + 1, weight)):
+            if row_weight == 0:
+                continue
+            row_cumulative = np.concatenate([[0.], np.cumsum(self.matrix[row], dtype=float)])
+            cumulative += row_weight * np.interp(self.bin_edges * energies[row] / energy, self.bin_edges, row_cumulative)
+
+        return np.diff(cumulative)
+
+    def fold(self, line_energies=(), line_intensities=(), continuum_energies=None, continuum_intensities=None,
+             FWHM=None, resolution_model='proportional', num_bins=1024):
+
+        if len(line_energies) != len(line_intensities):
+            raise ValueError("Every line energy needs an intensity.")
+
+        counts = np.zeros(self.num_bins)
+
+        for energy, intensity in zip(line_energies, line_intensities):
+            counts += intensity * self.response(energy)
+
+        if continuum_energies is not None:
+            counts += self._continuum_weights(continuum_energies, continuum_intensities) @ self.matrix
+
+        spectrum = ec.EnergyHistogram(num_bins=self.num_bins, energy_min=0., energy_max=self.energy_max)
+        centers = (self.bin_edges[:-1] + self.bin_edges[1:]) / 2
+        spectrum.hist += counts
+        spectrum.count = int(round(counts.sum()))
+        spectrum.sum = float(np.sum(counts * centers))
+        spectrum.sum_of_squares = float(np.sum(counts * centers**2))
+
+        if FWHM is not None:
+            spectrum = dr.broaden_histogram(spectrum, FWHM, model=resolution_model, num_bins=num_bins)
+
+        return spectrum
+
+    def _continuum_weights(self, continuum_energies, continuum_intensities, points_per_interval=64):
+        energies = self.incident_energies
+
+        # integrate the source density against the hat function of every grid energy
+        fine_energies = np.linspace(energies[0], energies[-1], points_per_interval * (len(energies) - 1) + 1)
+        density = np.interp(fine_energies, continuum_energies, continuum_intensities, left=0., right=0.)
+        step = np.gradient(fine_energies)
+        step[[0, -1]] /= 2
+
+        k = np.minimum(np.searchsorted(energies, fine_energies, side='right') - 1, len(energies) - 2)
+        fraction = (fine_energies - energies[k]) / (energies[k + 1] - energies[k])
+
+        weights = np.bincount(k, weights=density * step * (1 - fraction), minlength=len(energies))
+        weights += np.bincount(k + 1, weights=density * step * fraction, minlength=len(energies))
+
+        return weights
+
+
+def build_response_matrix(source_position, detector_height, detector_radius, NaI_density, incident_energies,
+                          num_particles, cross_sections_file_path, energy_max=None, batch_size=rs.DEFAULT_BLOCK_SIZE, seed=None,
+                          source_sampling='cylinder'):
+
+    incident_energies = np.sort(np.asarray(incident_energies, dtype=float))
+    energy_max = 1.1 * incident_energies[-1] if energy_max is None else energy_max
+
+    cross_section_table = csd.load_cross_section_table(cross_sections_file_path, NaI_density)
+
+    source_sampler = ss.make_source_sampler(source_position, detector_height, detector_radius, source_sampling)
+    pztop = detector_height / 2
+    pzbottom = -detector_height / 2
+    emitted = source_sampler.emitted_per_sampled * num_particles
+
+    matrix = np.zeros((len(incident_energies), ts.RAW_SPECTRUM_BINS), dtype=np.float32)
+    efficiencies_tot = np.zeros(len(incident_energies))
+    efficiencies_int = np.zeros(len(incident_energies))
+
+    for i, seed_sequence in enumerate(np.random.SeedSequence(seed).spawn(len(incident_energies))):
+        streams = rs.RandomStreams(seed_sequence, block_size=batch_size)
+        energy_accumulator, E_int = ts.simulate_transport_batch(source_position, incident_energies[i], cross_section_table,
+                                                               pztop, pzbottom, detector_radius, num_particles, source_sampler,
+                                                               streams, energy_max=energy_max)
+
+        # probability per emitted photon of depositing energy in each bin
+        matrix[i] = energy_accumulator.hist / emitted
+
+        efficiencies_tot[i], efficiencies_int[i] = ts.efficiencies(ec.total_energy_in_histogram(energy_accumulator), E_int,
+                                                                   source_sampler.emitted_per_sampled, num_particles,
+                                                                   incident_energies[i])
+
+    metadata = {
+        'source_position': np.asarray(source_position, dtype=float).tolist(),
+        'detector_height': detector_height,
+        'detector_radius': detector_radius,
+        'NaI_density': NaI_density,
+        'num_particles': num_particles,
+        'seed': seed,
+    }
+
+    return ResponseMatrix(incident_energies, matrix, energy_max, efficiencies_tot, efficiencies_int, metadata)
@@ -0,0 +1,219 @@
+import os
+import json
+import hashlib
+import numpy as np
+import cache_files as cf
+import cross_sections_data as csd
+import energy_calculation as ec
+import detector_resolution as dr
+import random_streams as rs
+import source_sampling as ss
+import transport_simulation as ts
+
+
+CODE_MODULES = ('transport_simulation', 'compton_scattering', 'calculating_geometric_properties',
+                'monte_carlo_initialisations', 'cross_sections_data', 'source_sampling', 'random_streams',
+                'energy_calculation', 'detector_resolution')
+
+_code_version = None
+
+
+def code_version():
+    global _code_version
+
+    if _code_version is None:
+        digest = hashlib.sha256()
+        for module in CODE_MODULES:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), f"{module}.py"), 'rb') as file:
+                digest.update(file.read())
+        _code_version = digest.hexdigest()
+
+    return _code_version
+
+
+def configuration_key(source_position, source_energy, detector_height, detector_radius, NaI_density,
+                      cross_sections_file_path, batch_size, seed, source_sampling):
+    if seed is None:
+        raise ValueError("Cached and sharded runs need an explicit seed.")
+
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+
+    # everything that decides the raw spectrum; FWHM is applied afterwards and is not part of it
+    config = {
+        'source_position': [float(x) for x in source_position],
+        'source_energy': float(source_energy),
+        'detector_height': float(detector_height),
+        'detector_radius': float(detector_radius),
+        'NaI_density': float(NaI_density),
+        'cross_sections': cf.file_hash(cross_sections_file_path),
+        'block_size': int(batch_size),
+        'seed': {'entropy': str(seed_sequence.entropy), 'spawn_key': [int(k) for k in seed_sequence.spawn_key]},
+        'source_sampling': source_sampling,
+        'code_version': code_version(),
+    }
+
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest(), config
+
+
+def _prefixed(prefix, histogram):
+    return {f"{prefix}_{name}": array for name, array in histogram.to_arrays().items()}
+
+
+def _unprefixed(prefix, arrays):
+    return ec.EnergyHistogram.from_arrays({name: arrays[f"{prefix}_{name}"] for name in ('hist', 'binning', 'totals')})
+
+
+class ResultCache:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source_position, source_energy, detector_height, detector_radius, NaI_density,
+            cross_sections_file_path, batch_size, seed, source_sampling):
+        return configuration_key(source_position, source_energy, detector_height, detector_radius, NaI_density,
+                                 cross_sections_file_path, batch_size, seed, source_sampling)
+
+    def _path(self, key, suffix=''):
+        return os.path.join(self.directory, f"{key}{suffix}.npz")
+
+    def load(self, key):
+        try:
+            with np.load(self._path(key)) as arrays:
+                if str(arrays['key']) != key:
+                    return None
+
+                counts = arrays['counts']
+                entry = {
+                    'config': json.loads(str(arrays['config'])),
+                    'base': _unprefixed('base', arrays),
+                    'base_particles': int(counts[0]),
+                    'base_E_int': float(counts[1]),
+                    'tail': _unprefixed('tail', arrays),
+                    'tail_particles': int(counts[2]),
+                    'tail_E_int': float(counts[3]),
+                    'emitted_per_sampled': float(counts[4]),
+                }
+        except (OSError, KeyError, ValueError):
+            return None
+
+        return entry
+
+    def save(self, key, entry):
+        num_particles = entry['base_particles'] + entry['tail_particles']
+        E_int = entry['base_E_int'] + entry['tail_E_int']
+        efficiencies = ts.efficiencies(entry['base'].sum + entry['tail'].sum, E_int, entry['emitted_per_sampled'],
+                                       num_particles, entry['config']['source_energy'])
+
+        arrays = {
+            'key': np.array(key),
+            'config': np.array(json.dumps(entry['config'], sort_keys=True)),
+            'counts': np.array([entry['base_particles'], entry['base_E_int'], entry['tail_particles'],
+                                entry['tail_E_int'], entry['emitted_per_sampled']]),
+            'efficiencies': np.array(efficiencies),
+            **_prefixed('base', entry['base']),
+            **_prefixed('tail', entry['tail']),
+        }
+
+        cf.atomic_savez(self._path(key), arrays, compressed=True)
+
+    def _broadened(self, key, histogram, num_particles, FWHM, resolution_model):
+        if FWHM is None:
+            return histogram
+
+        # a function has no stable name to key on, so its spectra are broadened again every time
+        if callable(resolution_model):
+            return dr.broaden_histogram(histogram, FWHM, model=resolution_model, num_bins=1024)
+
+        suffix = '.' + hashlib.sha256(json.dumps([FWHM, resolution_model, num_particles]).encode()).hexdigest()[:16]
+        path = self._path(key, suffix)
+
+        try:
+            return ec.EnergyHistogram.load(path)
+        except (OSError, KeyError, ValueError):
+            pass
+
+        broadened = dr.broaden_histogram(histogram, FWHM, model=resolution_model, num_bins=1024)
+        cf.atomic_savez(path, broadened.to_arrays(), compressed=True)
+
+        return broadened
+
+    def record_gamma_spectrum(self, source_position, source_energy, detector_height, detector_radius, NaI_density, FWHM,
+                              num_particles, cross_sections_file_path=None, batch_size=rs.DEFAULT_BLOCK_SIZE, workers=1,
+                              seed=None, resolution_model='proportional', source_sampling='cylinder',
+                              checkpoint_particles=1000000):
+
+        if cross_sections_file_path is None:
+            raise ValueError("Cross sections file path must be provided.")
+
+        key, config = self.key(source_position, source_energy, detector_height, detector_radius, NaI_density,
+                               cross_sections_file_path, batch_size, seed, source_sampling)
+        entry = self.load(key)
+
+        # histories up to the last whole block; the partial block after it is kept apart, because
+        # extending the run draws that block again in full
+        full_blocks_end = num_particles - num_particles % batch_size
+
+        if entry is not None and entry['base_particles'] > full_blocks_end:
+            return ts.record_gamma_spectrum(source_position, source_energy, detector_height, detector_radius, NaI_density,
+                                            FWHM, num_particles, cross_sections_file_path, batch_size=batch_size,
+                                            workers=workers, seed=seed, resolution_model=resolution_model,
+                                            source_sampling=source_sampling)
+
+        if entry is None or entry['base_particles'] + entry['tail_particles'] != num_particles:
+            entry = self._simulate(key, config, entry, num_particles, full_blocks_end, NaI_density, cross_sections_file_path,
+                                   workers, seed, checkpoint_particles)
+
+        energy_accumulator = ec.EnergyHistogram.from_arrays(entry['base'].to_arrays()).merge(entry['tail'])
+        E_int = entry['base_E_int'] + entry['tail_E_int']
+
+        efficiency_tot, efficiency_int = ts.efficiencies(ec.total_energy_in_histogram(energy_accumulator), E_int,
+                                                         entry['emitted_per_sampled'], num_particles, source_energy)
+
+        energy_accumulator = self._broadened(key, energy_accumulator, num_particles, FWHM, resolution_model)
+
+        return energy_accumulator, efficiency_tot, efficiency_int
+
+    def _simulate(self, key, config, entry, num_particles, full_blocks_end, NaI_density, cross_sections_file_path,
+                  workers, seed, checkpoint_particles):
+        source_position = np.asarray(config['source_position'])
+        source_energy = config['source_energy']
+        detector_height = config['detector_height']
+        detector_radius = config['detector_radius']
+        batch_size = config['block_size']
+
+        cross_section_table = csd.load_cross_section_table(cross_sections_file_path, NaI_density)
+        source_sampler = ss.make_source_sampler(source_position, detector_height, detector_radius, config['source_sampling'])
+        streams = rs.RandomStreams(seed, block_size=batch_size)
+
+        def empty_histogram():
+            return ec.EnergyHistogram(num_bins=ts.RAW_SPECTRUM_BINS, energy_min=0., energy_max=1.1 * source_energy)
+
+        if entry is None:
+            entry = {'config': config, 'base': empty_histogram(), 'base_particles': 0, 'base_E_int': 0.,
+                     'emitted_per_sampled': float(source_sampler.emitted_per_sampled)}
+
+        entry['tail'], entry['tail_particles'], entry['tail_E_int'] = empty_histogram(), 0, 0.
+
+        simulation_args = (source_position, source_energy, cross_section_table, detector_height / 2, -detector_height / 2,
+                           detector_radius)
+        segment = max(1, checkpoint_particles // batch_size) * batch_size
+
+        # whole-block segments, checkpointed one by one so an interrupted run picks up at the last one
+        while entry['base_particles'] < full_blocks_end:
+            n = min(segment, full_blocks_end - entry['base_particles'])
+            energy_accumulator, E_int = ts.simulate_transport_parallel(*simulation_args, n, source_sampler, streams,
+                                                                       workers=workers, first_history=entry['base_particles'])
+            entry['base'].merge(energy_accumulator)
+            entry['base_particles'] += n
+            entry['base_E_int'] += E_int
+            self.save(key, entry)
+
+        if num_particles > full_blocks_end:
+            entry['tail'], entry['tail_E_int'] = ts.simulate_transport_parallel(*simulation_args, num_particles - full_blocks_end,
+                                                                                source_sampler, streams, workers=workers,
+                                                                                first_history=full_blocks_end)
+            entry['tail_particles'] = num_particles - full_blocks_end
+
+        self.save(key, entry)
+
+        return entry
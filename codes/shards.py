@@ -0,0 +1,181 @@
+import os
+import json
+import argparse
+import numpy as np
+import cross_sections_data as csd
+import energy_calculation as ec
+import detector_resolution as dr
+import random_streams as rs
+import result_cache as rc
+import source_sampling as ss
+import transport_simulation as ts
+
+
+# the job spec shared by sharded runs and the simulation service
+JOB_DEFAULTS = {
+    'FWHM': None,
+    'batch_size': rs.DEFAULT_BLOCK_SIZE,
+    'seed': None,
+    'resolution_model': 'proportional',
+    'source_sampling': 'cylinder',
+}
+
+JOB_KEYS = ('source_position', 'source_energy', 'detector_height', 'detector_radius', 'NaI_density',
+            'num_particles', 'cross_sections_file_path')
+
+
+def load_job(path):
+    with open(path) as file:
+        job = {**JOB_DEFAULTS, **json.load(file)}
+
+    # every shard has to draw from the same streams, so a sharded job needs its seed
+    missing = [key for key in JOB_KEYS + ('seed',) if job.get(key) is None]
+    if missing:
+        raise ValueError(f"Job is missing: {', '.join(missing)}")
+
+    return job
+
+
+def job_key(job, num_shards):
+    key, config = rc.configuration_key(job['source_position'], job['source_energy'], job['detector_height'],
+                                       job['detector_radius'], job['NaI_density'], job['cross_sections_file_path'],
+                                       job['batch_size'], job['seed'], job['source_sampling'])
+
+    return key, {**config, 'num_particles': int(job['num_particles']), 'num_shards': int(num_shards)}
+
+
+def plan_shards(num_particles, num_shards, batch_size=rs.DEFAULT_BLOCK_SIZE):
+    if num_shards < 1:
+        raise ValueError("Number of shards must be at least 1.")
+
+    # shards cover disjoint whole blocks of one job's streams, so together they are exactly one run
+    chunks = rs.RandomStreams(0, block_size=batch_size).split(num_particles, num_shards)
+
+    return chunks + [(num_particles, 0)] * (num_shards - len(chunks))
+
+
+def run_shard(job, shard, num_shards, output_dir, workers=1):
+    if not 0 <= shard < num_shards:
+        raise ValueError(f"Shard index must be between 0 and {num_shards - 1}.")
+
+    key, config = job_key(job, num_shards)
+    first_history, num_photons = plan_shards(job['num_particles'], num_shards, job['batch_size'])[shard]
+
+    source_position = np.asarray(job['source_position'], dtype=float)
+    detector_height = job['detector_height']
+
+    cross_section_table = csd.load_cross_section_table(job['cross_sections_file_path'], job['NaI_density'])
+    source_sampler = ss.make_source_sampler(source_position, detector_height, job['detector_radius'], job['source_sampling'])
+    streams = rs.RandomStreams(job['seed'], block_size=job['batch_size'])
+
+    energy_accumulator, E_int = ts.simulate_transport_parallel(source_position, job['source_energy'], cross_section_table,
+                                                               detector_height / 2, -detector_height / 2, job['detector_radius'],
+                                                               num_photons, source_sampler, streams, workers=workers,
+                                                               first_history=first_history)
+
+    path = os.path.join(output_dir, f"shard_{key[:16]}_{shard:05d}_of_{num_shards:05d}.npz")
+    os.makedirs(output_dir, exist_ok=True)
+    np.savez_compressed(path,
+                        key=np.array(key),
+                        config=np.array(json.dumps(config, sort_keys=True)),
+                        job=np.array(json.dumps(job, sort_keys=True)),
+                        shard=np.array([shard, num_shards, first_history, num_photons]),
+                        detector_hits=np.array(round(E_int / job['source_energy'])),
+                        E_int=np.array(E_int),
+                        emitted_per_sampled=np.array(source_sampler.emitted_per_sampled),
+                        **energy_accumulator.to_arrays())
+
+    return path
+
+
+def read_shard(path):
+    with np.load(path) as arrays:
+        shard, num_shards, first_history, num_photons = (int(x) for x in arrays['shard'])
+        return {
+            'path': path,
+            'key': str(arrays['key']),
+            'config': json.loads(str(arrays['config'])),
+            'job': json.loads(str(arrays['job'])),
+            'shard': shard,
+            'num_shards': num_shards,
+            'first_history': first_history,
+            'num_photons': num_photons,
+            'detector_hits': int(arrays['detector_hits']),
+            'E_int': float(arrays['E_int']),
+            'emitted_per_sampled': float(arrays['emitted_per_sampled']),
+            'histogram': ec.EnergyHistogram.from_arrays(arrays),
+        }
+
+
+def merge_shards(paths):
+    shards = [read_shard(path) for path in paths]
+    if not shards:
+        raise ValueError("No shard files given.")
+
+    first = shards[0]
+    for shard in shards[1:]:
+        if shard['key'] != first['key'] or shard['config'] != first['config']:
+            raise ValueError(f"{shard['path']} belongs to a different job than {first['path']}.")
+
+    by_index = {}
+    for shard in shards:
+        if shard['shard'] in by_index:
+            raise ValueError(f"Shard {shard['shard']} given twice: {by_index[shard['shard']]['path']} and {shard['path']}.")
+        by_index[shard['shard']] = shard
+
+    num_shards = first['num_shards']
+    missing = sorted(set(range(num_shards)) - set(by_index))
+    if missing:
+        raise ValueError(f"Missing shards: {', '.join(map(str, missing))} of {num_shards}.")
+
+    job = first['job']
+    plan = plan_shards(job['num_particles'], num_shards, job['batch_size'])
+    for index, shard in by_index.items():
+        if (shard['first_history'], shard['num_photons']) != plan[index]:
+            raise ValueError(f"Shard {index} covers the wrong histories.")
+
+    # merged in shard order, the same order the blocks run in a single process
+    energy_accumulator = by_index[0]['histogram']
+    E_int = by_index[0]['E_int']
+    for index in range(1, num_shards):
+        energy_accumulator.merge(by_index[index]['histogram'])
+        E_int += by_index[index]['E_int']
+
+    efficiency_tot, efficiency_int = ts.efficiencies(ec.total_energy_in_histogram(energy_accumulator), E_int,
+                                                     first['emitted_per_sampled'], job['num_particles'], job['source_energy'])
+
+    if job['FWHM'] is not None:
+        energy_accumulator = dr.broaden_histogram(energy_accumulator, job['FWHM'], model=job['resolution_model'], num_bins=1024)
+
+    return energy_accumulator, efficiency_tot, efficiency_int
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Split one record_gamma_spectrum job into shards and merge them back.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='simulate one shard of a job')
+    run_parser.add_argument('job', help='JSON file with the record_gamma_spectrum arguments, seed included')
+    run_parser.add_argument('--shard', type=int, required=True)
+    run_parser.add_argument('--num-shards', type=int, required=True)
+    run_parser.add_argument('--output-dir', default='.')
+    run_parser.add_argument('--workers', type=int, default=1)
+
+    merge_parser = commands.add_parser('merge', help='check and merge the shard files of a job')
+    merge_parser.add_argument('shards', nargs='+')
+    merge_parser.add_argument('--output', help='npz file for the merged spectrum')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        print(run_shard(load_job(args.job), args.shard, args.num_shards, args.output_dir, args.workers))
+        return
+
+    energy_accumulator, efficiency_tot, efficiency_int = merge_shards(args.shards)
+    if args.output:
+        np.savez(args.output, efficiencies=np.array([efficiency_tot, efficiency_int]), **energy_accumulator.to_arrays())
+    print(json.dumps({'efficiency_tot': efficiency_tot, 'efficiency_int': efficiency_int}))
+
+
+if __name__ == "__main__":
+    main()
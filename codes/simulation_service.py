@@ -0,0 +1,458 @@
+import os
+import json
+import socket
+import asyncio
+import argparse
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cross_sections_data as csd
+import energy_calculation as ec
+import detector_resolution as dr
+import random_streams as rs
+import result_cache as rc
+import shards
+import source_sampling as ss
+import transport_simulation as ts
+
+
+_tables = {}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+
+
+def _is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def _validate_spec(spec):
+    # checked before the spec is hashed or handed to a worker, so a bad request fails alone with a readable error
+    if not isinstance(spec, dict):
+        raise ValueError("A job must be an object.")
+
+    missing = [key for key in shards.JOB_KEYS if spec.get(key) is None]
+    if missing:
+        raise ValueError(f"Job is missing: {', '.join(missing)}")
+
+    position = spec['source_position']
+    if not isinstance(position, (list, tuple)) or len(position) != 3 or not all(_is_number(x) for x in position):
+        raise ValueError("source_position must be three numbers.")
+
+    for key in ('source_energy', 'detector_height', 'detector_radius', 'NaI_density'):
+        if not _is_number(spec[key]) or spec[key] <= 0:
+            raise ValueError(f"{key} must be a positive number.")
+
+    for key in ('num_particles', 'batch_size'):
+        if not _is_count(spec[key]):
+            raise ValueError(f"{key} must be a positive integer.")
+
+    if spec['FWHM'] is not None and (not _is_number(spec['FWHM']) or spec['FWHM'] < 0):
+        raise ValueError("FWHM must be a non-negative number.")
+    if spec['seed'] is not None and not (isinstance(spec['seed'], int) and not isinstance(spec['seed'], bool) and spec['seed'] >= 0):
+        raise ValueError("seed must be a non-negative integer.")
+
+    path = spec['cross_sections_file_path']
+    if not isinstance(path, str) or not os.path.isfile(path):
+        raise ValueError(f"Cross sections file not found: {path}")
+
+    if spec['resolution_model'] not in dr.RESOLUTION_MODELS:
+        raise ValueError(f"resolution_model must be one of: {', '.join(dr.RESOLUTION_MODELS)}")
+    if spec['source_sampling'] not in ss.SAMPLING_METHODS:
+        raise ValueError(f"source_sampling must be one of: {', '.join(ss.SAMPLING_METHODS)}")
+
+
+def _run_segment(args):
+    table_key, simulation_args, num_photons, source_sampler, streams, first_history = args
+
+    # every worker keeps the tables it has loaded, so only its first job for a material pays for them
+    if table_key not in _tables:
+        _tables[table_key] = csd.load_cross_section_table(*table_key)
+
+    source_position, source_energy, pztop, pzbottom, radius = simulation_args
+    return ts.simulate_transport_batch(source_position, source_energy, _tables[table_key], pztop, pzbottom, radius,
+                                       num_photons, source_sampler, streams, first_history=first_history)
+
+
+def _histogram_to_json(histogram):
+    return {name: array.tolist() for name, array in histogram.to_arrays().items()}
+
+
+def histogram_from_json(arrays):
+    return ec.EnergyHistogram.from_arrays({name: np.array(values) for name, values in arrays.items()})
+
+
+class Job:
+    def __init__(self, job_id, key, spec, priority, sequence, segment_particles):
+        self.job_id = job_id
+        self.key = key
+        self.spec = spec
+        self.priority = priority
+        self.sequence = sequence
+
+        self.state = 'queued'
+        self.error = None
+        self.streams = rs.RandomStreams(spec['seed'], block_size=spec['batch_size'])
+        self.segments = self.streams.split(spec['num_particles'], max(1, -(-spec['num_particles'] // segment_particles)))
+        self.next_segment = 0
+        self.in_flight = 0
+        self.completed = {}
+        self.merged_segments = 0
+
+        self.histogram = ec.EnergyHistogram(num_bins=ts.RAW_SPECTRUM_BINS, energy_min=0., energy_max=1.1 * spec['source_energy'])
+        self.done_particles = 0
+        self.E_int = 0.
+        self.result = None
+
+        self.source_sampler = None
+        self.updated = asyncio.Condition()
+        self.finished = asyncio.Event()
+
+    def efficiencies(self):
+        if self.done_particles == 0:
+            return None, None
+
+        return ts.efficiencies(ec.total_energy_in_histogram(self.histogram), self.E_int,
+                               self.source_sampler.emitted_per_sampled, self.done_particles, self.spec['source_energy'])
+
+    def status(self):
+        efficiency_tot, efficiency_int = self.efficiencies()
+        return {
+            'job_id': self.job_id,
+            'state': self.state,
+            'error': self.error,
+            'priority': self.priority,
+            'num_particles': self.spec['num_particles'],
+            'done_particles': self.done_particles,
+            'progress': self.done_particles / self.spec['num_particles'] if self.spec['num_particles'] else 1.,
+            'efficiency_tot': efficiency_tot,
+            'efficiency_int': efficiency_int,
+        }
+
+
+class SimulationService:
+    def __init__(self, workers=1, segment_particles=8 * rs.DEFAULT_BLOCK_SIZE, max_finished_jobs=100):
+        if workers < 1:
+            raise ValueError("Number of workers must be at least 1.")
+
+        self.workers = workers
+        self.segment_particles = segment_particles
+        self.max_finished_jobs = max_finished_jobs
+
+        # started once and kept, so jobs skip the process start-up and find the tables already loaded
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.jobs = OrderedDict()
+        self.jobs_by_key = {}
+        self.in_flight = 0
+        self._sequence = itertools.count()
+        self._shutdown = None
+        self._connections = set()
+
+    def submit(self, spec, priority=0):
+        if not isinstance(spec, dict):
+            raise ValueError("A job must be an object.")
+        if not _is_number(priority):
+            raise ValueError("priority must be a number.")
+
+        spec = {**shards.JOB_DEFAULTS, **spec}
+        _validate_spec(spec)
+
+        # without a seed every request is its own run; the drawn seed is kept so the result can be reproduced
+        if spec['seed'] is None:
+            spec['seed'] = int(np.random.SeedSequence().entropy)
+
+        key, _ = rc.configuration_key(spec['source_position'], spec['source_energy'], spec['detector_height'],
+                                      spec['detector_radius'], spec['NaI_density'], spec['cross_sections_file_path'],
+                                      spec['batch_size'], spec['seed'], spec['source_sampling'])
+        key = f"{key}:{int(spec['num_particles'])}:{spec['FWHM']}:{spec['resolution_model']}"
+
+        # identical requests share one run, whether it is still queued, running or already done
+        existing = self.jobs_by_key.get(key)
+        if existing is not None and existing.state not in ('failed', 'cancelled'):
+            existing.priority = max(existing.priority, priority)
+            return existing, True
+
+        job_id = f"{key[:12]}-{next(self._sequence)}"
+        job = Job(job_id, key, spec, priority, next(self._sequence), self.segment_particles)
+
+        source_position = np.asarray(spec['source_position'], dtype=float)
+        job.source_sampler = ss.make_source_sampler(source_position, spec['detector_height'], spec['detector_radius'],
+                                                    spec['source_sampling'])
+        job.simulation_args = (source_position, spec['source_energy'], spec['detector_height'] / 2,
+                               -spec['detector_height'] / 2, spec['detector_radius'])
+
+        self.jobs[job_id] = job
+        self.jobs_by_key[key] = job
+        self._evict()
+        self._fill()
+
+        return job, False
+
+    def cancel(self, job_id):
+        job = self.jobs[job_id]
+        if job.state in ('queued', 'running'):
+            job.state = 'cancelled'
+            job.finished.set()
+            self.jobs_by_key.pop(job.key, None)
+            asyncio.ensure_future(self._notify(job))
+
+        return job
+
+    def _evict(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished.is_set()]
+        for job_id in finished[:max(0, len(finished) - self.max_finished_jobs)]:
+            job = self.jobs.pop(job_id)
+            if self.jobs_by_key.get(job.key) is job:
+                del self.jobs_by_key[job.key]
+
+    def _next_job(self):
+        waiting = [job for job in self.jobs.values()
+                   if job.state in ('queued', 'running') and job.next_segment < len(job.segments)]
+
+        # highest priority first, then first come first served
+        return min(waiting, key=lambda job: (-job.priority, job.sequence), default=None)
+
+    def _fill(self):
+        # segments are handed out one at a time, so a more urgent job takes over at the next free worker
+        while self.in_flight < self.workers:
+            job = self._next_job()
+            if job is None:
+                return
+
+            index = job.next_segment
+            job.next_segment += 1
+            job.state = 'running'
+            self.in_flight += 1
+            job.in_flight += 1
+            asyncio.ensure_future(self._run_segment(job, index))
+
+    async def _run_segment(self, job, index):
+        first_history, num_photons = job.segments[index]
+        table_key = (job.spec['cross_sections_file_path'], job.spec['NaI_density'])
+        args = (table_key, job.simulation_args, num_photons, job.source_sampler, job.streams, first_history)
+
+        try:
+            job.completed[index] = await asyncio.get_running_loop().run_in_executor(self.pool, _run_segment, args)
+        except Exception as error:
+            if job.state == 'running':
+                job.state = 'failed'
+                job.error = repr(error)
+                job.finished.set()
+                self.jobs_by_key.pop(job.key, None)
+                await self._notify(job)
+        finally:
+            self.in_flight -= 1
+            job.in_flight -= 1
+
+        if job.state == 'running':
+            try:
+                await self._merge(job)
+            except Exception as error:
+                # a job whose merge or broadening fails still ends, so nobody waits on it forever
+                job.state = 'failed'
+                job.error = repr(error)
+                job.finished.set()
+                self.jobs_by_key.pop(job.key, None)
+                await self._notify(job)
+
+        self._fill()
+
+    async def _merge(self, job):
+        # merged in segment order, so a partial histogram always covers the first histories of the run
+        while job.merged_segments in job.completed:
+            energy_accumulator, E_int = job.completed.pop(job.merged_segments)
+            job.histogram.merge(energy_accumulator)
+            job.E_int += E_int
+            job.done_particles += job.segments[job.merged_segments][1]
+            job.merged_segments += 1
+
+        if job.merged_segments == len(job.segments):
+            efficiency_tot, efficiency_int = job.efficiencies()
+            histogram = job.histogram
+            if job.spec['FWHM'] is not None:
+                histogram = await asyncio.to_thread(dr.broaden_histogram, job.histogram, job.spec['FWHM'],
+                                                    model=job.spec['resolution_model'], num_bins=1024)
+
+            job.result = {'efficiency_tot': efficiency_tot, 'efficiency_int': efficiency_int,
+                          'histogram': _histogram_to_json(histogram)}
+            job.state = 'done'
+            job.finished.set()
+
+        await self._notify(job)
+
+    async def _notify(self, job):
+        async with job.updated:
+            job.updated.notify_all()
+
+    async def _handle(self, reader, writer):
+        async def send(message):
+            writer.write((json.dumps(message) + '\n').encode())
+            await writer.drain()
+
+        self._connections.add(asyncio.current_task())
+        try:
+            while line := await reader.readline():
+                # a bad request gets an error reply and the connection stays open for the next one
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("A request must be an object.")
+                    await self._respond(request, send)
+                except (ConnectionError, asyncio.CancelledError):
+                    raise
+                except Exception as error:
+                    await send({'request_error': str(error) or repr(error)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # the service is shutting down; the client sees its connection close
+            pass
+        finally:
+            self._connections.discard(asyncio.current_task())
+            writer.close()
+
+    async def _respond(self, request, send):
+        op = request.get('op')
+
+        if op == 'submit':
+            job, coalesced = self.submit(request['job'], request.get('priority', 0))
+            await send({**job.status(), 'coalesced': coalesced, 'seed': job.spec['seed']})
+
+        elif op == 'status':
+            await send(self.jobs[request['job_id']].status())
+
+        elif op == 'result':
+            job = self.jobs[request['job_id']]
+            if request.get('wait', True):
+                await job.finished.wait()
+            await send({**job.status(), **(job.result or {})})
+
+        elif op == 'stream':
+            # one message per merged segment with the partial raw histogram, the last one once the job is over
+            job = self.jobs[request['job_id']]
+            while True:
+                finished = job.finished.is_set()
+                done_particles = job.done_particles
+                await send({**job.status(), 'histogram': _histogram_to_json(job.histogram)})
+                if finished:
+                    return
+
+                async with job.updated:
+                    await job.updated.wait_for(lambda: job.done_particles != done_particles or job.finished.is_set())
+
+        elif op == 'cancel':
+            await send(self.cancel(request['job_id']).status())
+
+        elif op == 'jobs':
+            await send({'jobs': [job.status() for job in self.jobs.values()]})
+
+        elif op == 'shutdown':
+            await send({'state': 'shutting down'})
+            self._shutdown.set()
+
+        else:
+            raise ValueError(f"Unknown operation: {op}")
+
+    async def serve(self, path=None, host='127.0.0.1', port=8765, ready=None):
+        self._shutdown = asyncio.Event()
+
+        if path is not None:
+            server = await asyncio.start_unix_server(self._handle, path)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+
+        if ready is not None:
+            ready()
+
+        async with server:
+            await self._shutdown.wait()
+
+            connections = [task for task in self._connections if task is not asyncio.current_task()]
+            for task in connections:
+                task.cancel()
+            await asyncio.gather(*connections, return_exceptions=True)
+
+        self.pool.shutdown(cancel_futures=True)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+
+class SimulationClient:
+    def __init__(self, path=None, host='127.0.0.1', port=8765, timeout=None):
+        if path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(path)
+        else:
+            self.socket = socket.create_connection((host, port))
+        self.socket.settimeout(timeout)
+        self.file = self.socket.makefile('rw')
+
+    def _request(self, **request):
+        self.file.write(json.dumps(request) + '\n')
+        self.file.flush()
+        return self._receive()
+
+    def _receive(self):
+        response = json.loads(self.file.readline())
+        if 'request_error' in response:
+            raise ValueError(response['request_error'])
+        return response
+
+    def submit(self, priority=0, **job):
+        return self._request(op='submit', job=job, priority=priority)
+
+    def status(self, job_id):
+        return self._request(op='status', job_id=job_id)
+
+    def result(self, job_id):
+        response = self._request(op='result', job_id=job_id, wait=True)
+        if response['state'] != 'done':
+            raise ValueError(f"Job {job_id} ended as {response['state']}: {response['error']}")
+
+        return histogram_from_json(response['histogram']), response['efficiency_tot'], response['efficiency_int']
+
+    def stream(self, job_id):
+        # yields the status with the partial raw histogram until the job is over
+        response = self._request(op='stream', job_id=job_id)
+        while True:
+            response['histogram'] = histogram_from_json(response['histogram'])
+            yield response
+            if response['state'] not in ('queued', 'running'):
+                return
+            response = self._receive()
+
+    def cancel(self, job_id):
+        return self._request(op='cancel', job_id=job_id)
+
+    def shutdown(self):
+        return self._request(op='shutdown')
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep cross sections and workers warm and run simulation jobs from a queue.')
+    parser.add_argument('--socket', help='Unix socket path; localhost TCP is used when it is not given')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--segment-particles', type=int, default=8 * rs.DEFAULT_BLOCK_SIZE)
+    args = parser.parse_args()
+
+    service = SimulationService(args.workers, args.segment_particles)
+    asyncio.run(service.serve(args.socket, args.host, args.port,
+                              ready=lambda: print(f"listening on {args.socket or f'{args.host}:{args.port}'}", flush=True)))
+
+
+if __name__ == "__main__":
+    main()
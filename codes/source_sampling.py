@@ -0,0 +1,182 @@
+import numpy as np
+import calculating_geometric_properties as cgp
+import monte_carlo_initialisations as mci
+
+
+SAMPLING_METHODS = ('cylinder', 'cone')
+
+
+def disk_solid_angle(distance, offset, radius):
+    # disk of the given radius seen from a point at the given distance from its plane
+    # and the given offset from its axis
+    import scipy.integrate
+
+    if distance <= 0:
+        return 0.0
+
+    def integrand(phi):
+        c = offset * np.cos(phi)
+        b2 = distance**2 + (offset * np.sin(phi))**2
+
+        def primitive(q):
+            return -1 / np.sqrt(q**2 + b2) + c * q / (b2 * np.sqrt(q**2 + b2))
+
+        return distance * (primitive(radius - c) - primitive(-c))
+
+    value, _ = scipy.integrate.quad(integrand, 0, np.pi, epsabs=1e-14, epsrel=1e-12, limit=500)
+
+    return 2 * value
+
+
+def side_solid_angle(offset, z, pztop, pzbottom, radius):
+    # visible part of the mantle seen from a point at the given offset from the axis
+    import scipy.integrate
+
+    if offset <= radius:
+        return 0.0
+
+    def integrand(phi):
+        d2 = radius**2 + offset**2 - 2 * radius * offset * np.cos(phi)
+        u_top = pztop - z
+        u_bottom = pzbottom - z
+
+        return (radius * (offset * np.cos(phi) - radius) / d2
+                * (u_top / np.sqrt(d2 + u_top**2) - u_bottom / np.sqrt(d2 + u_bottom**2)))
+
+    value, _ = scipy.integrate.quad(integrand, 0, np.arccos(radius / offset), epsabs=1e-14, epsrel=1e-12, limit=500)
+
+    return 2 * value
+
+
+def _bounding_cone(source_position, points, center):
+    axis = center - source_position
+    axis /= np.linalg.norm(axis)
+
+    to_points = points - source_position
+    cos_angles = to_points @ axis / np.linalg.norm(to_points, axis=1)
+    angle = np.arccos(np.clip(cos_angles.min(), -1, 1))
+
+    # the cone is only convex, and so only guaranteed to hold the whole face, below pi/2
+    if angle >= np.pi / 2 - 1e-3:
+        return axis, np.pi
+
+    return axis, min(angle * (1 + 1e-6) + 1e-9, np.pi)
+
+
+class ConeSourceSampler:
+    def __init__(self, source_position, detector_height, detector_radius):
+        self.source_position = np.asarray(source_position, dtype=float)
+        self.detector_height = detector_height
+        self.detector_radius = detector_radius
+        self.alpha = cgp.calc_angle_of_cone(self.source_position, detector_height, detector_radius)
+
+        if np.linalg.norm(self.source_position) < np.sqrt(detector_radius**2 + detector_height**2 / 4):
+            self.solid_angle = 4 * np.pi
+        else:
+            self.solid_angle = 2 * np.pi * (1 - np.cos(self.alpha))
+
+        self.emitted_per_sampled = 4 * np.pi / self.solid_angle
+
+    def sample(self, num_directions, rng):
+        return mci.isotropic_directions_in_cone(self.alpha, self.source_position, self.detector_height,
+                                                self.detector_radius, num_directions, rng)
+
+
+class CylinderSourceSampler:
+    def __init__(self, source_position, pztop, pzbottom, radius, rim_points=4096):
+        self.source_position = np.asarray(source_position, dtype=float)
+        self.pztop = pztop
+        self.pzbottom = pzbottom
+        self.radius = radius
+
+        x, y, z = self.source_position
+        offset = np.hypot(x, y)
+
+        self.inside = offset <= radius and pzbottom <= z <= pztop
+
+        if self.inside:
+            self.face_solid_angles = np.array([0.0, 0.0, 0.0])
+            self.solid_angle = 4 * np.pi
+        else:
+            self.face_solid_angles = np.array([
+                disk_solid_angle(z - pztop, offset, radius),
+                disk_solid_angle(pzbottom - z, offset, radius),
+                side_solid_angle(offset, z, pztop, pzbottom, radius),
+            ])
+            self.solid_angle = self.face_solid_angles.sum()
+
+        self.emitted_per_sampled = 4 * np.pi / self.solid_angle
+        self.face_probabilities = self.face_solid_angles / self.face_solid_angles.sum() if not self.inside else None
+
+        # a source inside samples the full sphere; on a face centre the cone axes would not even be defined
+        self.cones = None
+        if self.inside:
+            return
+
+        phi = np.linspace(0, 2 * np.pi, rim_points, endpoint=False)
+        rim = np.column_stack([radius * np.cos(phi), radius * np.sin(phi), np.zeros(rim_points)])
+        top_rim = rim + [0, 0, pztop]
+        bottom_rim = rim + [0, 0, pzbottom]
+
+        self.cones = [
+            _bounding_cone(self.source_position, top_rim, np.array([0, 0, pztop])),
+            _bounding_cone(self.source_position, bottom_rim, np.array([0, 0, pzbottom])),
+            _bounding_cone(self.source_position, np.vstack([top_rim, bottom_rim]), np.array([0, 0, (pztop + pzbottom) / 2])),
+        ]
+
+    def _hits_face(self, face, directions):
+        n = len(directions)
+        positions = np.broadcast_to(self.source_position, (n, 3))
+
+        if face == 2:
+            t = cgp.intersect_cylinder_batch(positions, directions, self.radius)[:, 0]
+            z = self.source_position[2] + t * directions[:, 2]
+            return np.isfinite(t) & (t > 0) & (z >= self.pzbottom) & (z <= self.pztop)
+
+        plane = self.pztop if face == 0 else self.pzbottom
+        dz = directions[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = (plane - self.source_position[2]) / dz
+        x = self.source_position[0] + t * directions[:, 0]
+        y = self.source_position[1] + t * directions[:, 1]
+
+        return (t > 0) & (x**2 + y**2 <= self.radius**2)
+
+    def _sample_face(self, face, num_directions, rng):
+        axis, angle = self.cones[face]
+
+        directions = np.empty((num_directions, 3))
+        pending = np.arange(num_directions)
+
+        # uniform in the bounding cone, rejecting the directions that do not enter through this face
+        while pending.size:
+            candidates = mci.transform_direction(mci.isotropic_directions_in_angle(angle, pending.size, rng).T, axis).T
+            accepted = self._hits_face(face, candidates)
+            directions[pending[accepted]] = candidates[accepted]
+            pending = pending[~accepted]
+
+        return directions
+
+    def sample(self, num_directions, rng):
+        if self.inside:
+            return mci.isotropic_directions_in_angle(np.pi, num_directions, rng)
+
+        faces = np.searchsorted(np.cumsum(self.face_probabilities), rng.random(num_directions), side='right')
+        faces = np.minimum(faces, 2)
+
+        directions = np.empty((num_directions, 3))
+        for face in range(3):
+            chosen = np.flatnonzero(faces == face)
+            if chosen.size:
+                directions[chosen] = self._sample_face(face, chosen.size, rng)
+
+        return directions
+
+
+def make_source_sampler(source_position, detector_height, detector_radius, method='cylinder'):
+    if method == 'cylinder':
+        return CylinderSourceSampler(source_position, detector_height / 2, -detector_height / 2, detector_radius)
+    if method == 'cone':
+        return ConeSourceSampler(source_position, detector_height, detector_radius)
+
+    raise ValueError(f"Unknown source sampling method: {method}")
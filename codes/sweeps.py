@@ -0,0 +1,199 @@
+import itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import cross_sections_data as csd
+import energy_calculation as ec
+import detector_resolution as dr
+import random_streams as rs
+import source_sampling as ss
+import transport_simulation as ts
+
+
+_cross_section_table = None
+
+ENGINES = {'batch': ts.simulate_transport_batch, 'scalar': ts.simulate_transport}
+
+
+def make_grid(source_positions, source_energies, detector_heights, detector_radii, FWHMs=(None,)):
+    return [{'source_position': np.asarray(source_position, dtype=float), 'source_energy': source_energy,
+             'detector_height': detector_height, 'detector_radius': detector_radius, 'FWHM': FWHM}
+            for source_position, source_energy, detector_height, detector_radius, FWHM
+            in itertools.product(source_positions, source_energies, detector_heights, detector_radii, FWHMs)]
+
+
+def expected_cost(cross_section_table, source_energy, detector_height, detector_radius, num_particles):
+    # photons times the mean number of interactions along the mean chord of the crystal (Cauchy: 4V/S)
+    mean_chord = 2 * detector_radius * detector_height / (detector_radius + detector_height)
+    total = cross_section_table.lookup(source_energy)[3]
+
+    return num_particles * (1 + total * mean_chord)
+
+
+def _install_table(cross_section_table):
+    global _cross_section_table
+    _cross_section_table = cross_section_table
+
+
+def _run_task(task):
+    index, chunk, simulation_args, num_photons, source_sampler, streams, first_history, engine = task
+
+    # one engine call per block, so every block's tallies are kept for the correlated errors
+    energy_accumulator = None
+    blocks = []
+    for _, start, stop in streams.blocks(first_history, num_photons):
+        block_accumulator, E_int = ENGINES[engine](*simulation_args[:2], _cross_section_table, *simulation_args[2:],
+                                                   stop - start, source_sampler, streams, first_history=start)
+        energy_accumulator = block_accumulator if energy_accumulator is None else energy_accumulator.merge(block_accumulator)
+        blocks.append((stop - start, block_accumulator.sum, E_int))
+
+    return index, chunk, energy_accumulator, blocks
+
+
+def run_sweep(configs, NaI_density, num_particles, cross_sections_file_path, workers=1, batch_size=rs.DEFAULT_BLOCK_SIZE,
+              seed=None, resolution_model='proportional', source_sampling='cylinder', tasks_per_worker=4,
+              common_random_numbers=False, engine='batch'):
+
+    if workers < 1:
+        raise ValueError("Number of workers must be at least 1.")
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine: {engine}")
+
+    configs = list(configs)
+
+    # common random numbers: every point draws history i from the same stream, so neighbouring points are correlated
+    if common_random_numbers:
+        if any('seed' in config for config in configs):
+            raise ValueError("Common random numbers use one seed for the whole sweep, not one per point.")
+        seed_sequences = [np.random.SeedSequence(seed)] * len(configs)
+    else:
+        seed_sequences = np.random.SeedSequence(seed).spawn(len(configs))
+    cross_section_table = csd.load_cross_section_table(cross_sections_file_path, NaI_density)
+
+    # one sampler per distinct geometry, shared by every energy and resolution at that geometry
+    samplers = {}
+    points = []
+    for config, seed_sequence in zip(configs, seed_sequences):
+        source_position = np.asarray(config['source_position'], dtype=float)
+        geometry = (tuple(source_position), config['detector_height'], config['detector_radius'])
+        if geometry not in samplers:
+            samplers[geometry] = ss.make_source_sampler(source_position, config['detector_height'],
+                                                        config['detector_radius'], source_sampling)
+
+        n = config.get('num_particles', num_particles)
+        streams = rs.RandomStreams(config.get('seed', seed_sequence), block_size=batch_size)
+        cost = expected_cost(cross_section_table, config['source_energy'], config['detector_height'], config['detector_radius'], n)
+        points.append((source_position, samplers[geometry], n, streams, cost))
+
+    # chunks of roughly equal expected cost, the most expensive handed out first
+    target_cost = sum(point[4] for point in points) / (workers * tasks_per_worker)
+    tasks = []
+    chunk_counts = []
+    for index, (config, (source_position, source_sampler, n, streams, cost)) in enumerate(zip(configs, points)):
+        simulation_args = (source_position, config['source_energy'], config['detector_height'] / 2,
+                           -config['detector_height'] / 2, config['detector_radius'])
+        chunks = streams.split(n, max(1, int(round(cost / target_cost))))
+        chunk_counts.append(len(chunks))
+        for chunk, (first_history, chunk_size) in enumerate(chunks):
+            tasks.append((cost * chunk_size / max(n, 1), (index, chunk, simulation_args, chunk_size, source_sampler, streams,
+                                                          first_history, engine)))
+
+    tasks = [task for _, task in sorted(tasks, key=lambda item: -item[0])]
+
+    if workers == 1:
+        _install_table(cross_section_table)
+        results = map(_run_task, sorted(tasks, key=lambda task: task[:2]))
+        yield from _collect(results, configs, points, chunk_counts, resolution_model)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_install_table, initargs=(cross_section_table,)) as executor:
+        futures = [executor.submit(_run_task, task) for task in tasks]
+        yield from _collect((future.result() for future in as_completed(futures)), configs, points, chunk_counts,
+                            resolution_model)
+
+
+def _collect(results, configs, points, chunk_counts, resolution_model):
+    pending = {}
+
+    for index, chunk, energy_accumulator, blocks in results:
+        pending.setdefault(index, {})[chunk] = (energy_accumulator, blocks)
+        if len(pending[index]) < chunk_counts[index]:
+            continue
+
+        # merged in chunk order, so a point does not depend on which chunk finished first
+        chunks = pending.pop(index)
+        energy_accumulator, blocks = chunks[0]
+        for chunk in range(1, chunk_counts[index]):
+            energy_accumulator.merge(chunks[chunk][0])
+            blocks = blocks + chunks[chunk][1]
+
+        blocks = np.array(blocks, dtype=float).reshape(-1, 3)
+        E_int = blocks[:, 2].sum()
+
+        config = configs[index]
+        _, source_sampler, n, _, _ = points[index]
+
+        efficiency_tot, efficiency_int = ts.efficiencies(ec.total_energy_in_histogram(energy_accumulator), E_int,
+                                                         source_sampler.emitted_per_sampled, n, config['source_energy'])
+
+        FWHM = config.get('FWHM')
+        if FWHM is not None:
+            energy_accumulator = dr.broaden_histogram(energy_accumulator, FWHM, model=resolution_model, num_bins=1024)
+
+        yield {
+            'index': index,
+            'config': config,
+            'num_particles': n,
+            'histogram': energy_accumulator,
+            'efficiency_tot': efficiency_tot,
+            'efficiency_int': efficiency_int,
+            'emitted_per_sampled': source_sampler.emitted_per_sampled,
+            'blocks': {'histories': blocks[:, 0], 'E_det': blocks[:, 1], 'E_int': blocks[:, 2]},
+        }
+
+
+def _block_scores(result, quantity):
+    blocks = result['blocks']
+    if quantity == 'efficiency_tot':
+        denominators = result['emitted_per_sampled'] * blocks['histories'] * result['config']['source_energy']
+    elif quantity == 'efficiency_int':
+        denominators = blocks['E_int']
+    else:
+        raise ValueError(f"Unknown quantity: {quantity}")
+
+    # linearised ratio estimator: every block's share of the deviation from the pooled efficiency
+    efficiency = blocks['E_det'].sum() / denominators.sum()
+    return efficiency, (blocks['E_det'] - efficiency * denominators) / denominators.sum()
+
+
+def compare_points(result_a, result_b, quantity='efficiency_tot'):
+    if not np.array_equal(result_a['blocks']['histories'], result_b['blocks']['histories']):
+        raise ValueError("Only points run over the same histories can be compared.")
+
+    efficiency_a, scores_a = _block_scores(result_a, quantity)
+    efficiency_b, scores_b = _block_scores(result_b, quantity)
+
+    # blocks are independent streams, so their scatter gives the variances and the covariance of the two points
+    num_blocks = len(scores_a)
+    if num_blocks < 2:
+        raise ValueError("Correlated errors need at least two blocks.")
+
+    factor = num_blocks / (num_blocks - 1)
+    variance_a = factor * np.sum(scores_a**2)
+    variance_b = factor * np.sum(scores_b**2)
+    covariance = factor * np.sum(scores_a * scores_b)
+
+    ratio = efficiency_a / efficiency_b
+    ratio_variance = ratio**2 * (variance_a / efficiency_a**2 + variance_b / efficiency_b**2
+                                 - 2 * covariance / (efficiency_a * efficiency_b))
+
+    return {
+        'efficiency_a': efficiency_a,
+        'efficiency_b': efficiency_b,
+        'error_a': np.sqrt(variance_a),
+        'error_b': np.sqrt(variance_b),
+        'correlation': covariance / np.sqrt(variance_a * variance_b) if variance_a * variance_b > 0 else 0.,
+        'difference': efficiency_a - efficiency_b,
+        'difference_error': np.sqrt(max(variance_a + variance_b - 2 * covariance, 0.)),
+        'ratio': ratio,
+        'ratio_error': np.sqrt(max(ratio_variance, 0.)),
+    }
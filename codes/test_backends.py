@@ -0,0 +1,78 @@
+import functools
+import warnings
+import numpy as np
+import pytest
+import benchmarks
+import transport_simulation as ts
+import numba_transport as nt
+
+
+# the pair scenario goes through every interaction, including the annihilation photons; the other two put the source
+# on the crystal surface, where the engines must agree on which photons enter
+CASES = {
+    'pair': benchmarks.SCENARIOS['pair'],
+    'face': {**benchmarks.SCENARIOS['A'], 'source_position': [0.0, 0.0, 1.5]},
+    'mantle': {**benchmarks.SCENARIOS['A'], 'source_position': [2.5, 0.0, 0.0]},
+}
+NUM_PARTICLES = {'python': 10000, 'numpy': 200000, 'numba': 200000}
+SEED = 12345
+
+# wide bins, as the scalar run is small; a fixed seed makes the outcome reproducible
+REBIN = 256
+PARITY_LEVEL = 0.001
+
+requires_numba = pytest.mark.skipif(not nt.NUMBA_AVAILABLE, reason='numba is not installed')
+
+
+@functools.lru_cache(maxsize=None)
+def _spectrum(case, backend):
+    scenario = CASES[case]
+    energy_histogram, _, _ = ts.record_gamma_spectrum(
+        np.array(scenario['source_position']), scenario['source_energy'], scenario['detector_height'],
+        scenario['detector_radius'], benchmarks.NaI_DENSITY, None, NUM_PARTICLES[backend],
+        cross_sections_file_path=benchmarks.CROSS_SECTIONS_FILE, batch_size=None if backend == 'python' else 8192,
+        seed=SEED, backend=backend)
+
+    return energy_histogram
+
+
+def _assert_parity(case, backend, reference_backend):
+    parity = benchmarks.spectrum_parity(_spectrum(case, backend), _spectrum(case, reference_backend), rebin=REBIN,
+                                        num_particles=NUM_PARTICLES[backend], reference_particles=NUM_PARTICLES[reference_backend])
+    assert parity['p_value'] >= PARITY_LEVEL, f"{case}: {backend} and {reference_backend} spectra differ: {parity}"
+
+
+@pytest.mark.parametrize('case', CASES)
+def test_python_matches_numpy(case):
+    _assert_parity(case, 'python', 'numpy')
+
+
+@requires_numba
+@pytest.mark.parametrize('case', CASES)
+def test_numba_matches_numpy(case):
+    _assert_parity(case, 'numba', 'numpy')
+
+
+@requires_numba
+@pytest.mark.parametrize('case', CASES)
+def test_numba_matches_python(case):
+    _assert_parity(case, 'numba', 'python')
+
+
+def test_numba_falls_back_without_numba(monkeypatch):
+    monkeypatch.setattr(nt, 'NUMBA_AVAILABLE', False)
+
+    with pytest.warns(RuntimeWarning, match='numba is not installed'):
+        assert ts.select_backend('numba') == 'numpy'
+
+
+def test_other_backends_do_not_warn():
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        assert ts.select_backend('python') == 'python'
+        assert ts.select_backend('numpy') == 'numpy'
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        ts.select_backend('cuda')
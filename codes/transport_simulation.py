@@ -1,197 +1,648 @@
+import os
+import time
+import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import cross_sections_data as csd
 import monte_carlo_initialisations as mci
 import calculating_geometric_properties as cgp
 import energy_calculation as ec
+import compton_scattering as cs
+import detector_resolution as dr
+import source_sampling as ss
+import random_streams as rs
+import profiling as prof
+import event_output as eo
 
 
-def pair_production_simulation(position, energy, pztop, pzbottom, radius, compton_scattering_cross_sections, photoelectric_absorption_cross_sections):
+RAW_SPECTRUM_BINS = 8192
 
-    direction1 = mci.isotropic_direction_in_angle(np.pi)
-    direction2 = -direction1
-    energy1 = 0.511
-    energy2 = 0.511
-    position1 = position.copy()
-    position2 = position.copy()
+BACKENDS = ('python', 'numpy', 'numba')
 
-    compton_cross_section = csd.get_cross_section(energy1, energy, compton_scattering_cross_sections)
-    photoelectric_cross_section = csd.get_cross_section(energy1, energy, photoelectric_absorption_cross_sections)
-    total_cross_section = compton_cross_section + photoelectric_cross_section  
 
-    summing_energy = 0
+def select_backend(backend):
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown transport backend: {backend}")
 
-    while True:
+    # numba takes longer to import than the rest of the engine, so only runs that ask for it load it
+    if backend == 'numba':
+        import numba_transport as nt
+        if not nt.NUMBA_AVAILABLE:
+            warnings.warn("numba is not installed, falling back to the numpy backend.", RuntimeWarning, stacklevel=2)
+            return 'numpy'
 
-        if energy1 < 0.001:
-                break
+    return backend
 
-        random_numbers = np.random.rand(2)
 
-        lambd = -np.log(random_numbers[0]) / total_cross_section
+class VarianceReduction:
+    def __init__(self, forced_interaction=True, roulette_energy=None, roulette_weight=0.5):
+        if not 0 < roulette_weight <= 1:
+            raise ValueError("Roulette weight must be in (0, 1].")
 
-        if cgp.goes_outside(position1, direction1, pztop, pzbottom, radius, lambd):
-            break
+        self.forced_interaction = forced_interaction
+        self.roulette_energy = roulette_energy
+        self.roulette_weight = roulette_weight
 
-        position1 += direction1 * lambd
 
-        compton_scatter = random_numbers[1] < (compton_cross_section / total_cross_section)
-        if compton_scatter:
-            direction1, energy1, detector_energy = mci.compton_scatter_photon(energy1, direction1)
+class ParticleStack:
+    def __init__(self):
+        self._entries = []
 
-            summing_energy += detector_energy
+    def __len__(self):
+        return sum(len(entry[0]) for entry in self._entries)
 
-        photoelectric_absorb = random_numbers[1] < ((photoelectric_cross_section + compton_cross_section) / total_cross_section) and not compton_scatter
-        if photoelectric_absorb:
+    def push(self, history, positions, directions, energies):
+        if len(history):
+            self._entries.append((np.asarray(history), np.asarray(positions, dtype=float),
+                                  np.asarray(directions, dtype=float), np.asarray(energies, dtype=float)))
 
-            summing_energy += energy1
-            break
+    def pop_all(self):
+        entries, self._entries = self._entries, []
 
+        return tuple(np.concatenate(column) for column in zip(*entries))
 
-        compton_cross_section = csd.get_cross_section(energy1, energy, compton_scattering_cross_sections)
-        photoelectric_cross_section = csd.get_cross_section(energy1, energy, photoelectric_absorption_cross_sections)
-        total_cross_section = compton_cross_section + photoelectric_cross_section
 
+def push_annihilation_photons(stack, history, positions, rng):
+    directions = mci.isotropic_directions_in_angle(np.pi, len(history), rng)
 
-    compton_cross_section = csd.get_cross_section(energy2, energy, compton_scattering_cross_sections)
-    photoelectric_cross_section = csd.get_cross_section(energy2, energy, photoelectric_absorption_cross_sections)
-    total_cross_section = compton_cross_section + photoelectric_cross_section  
+    stats = prof.active()
+    if stats is not None:
+        stats.count('secondaries', 2 * len(history))
 
-    while True:
+    stack.push(np.concatenate([history, history]), np.concatenate([positions, positions]),
+               np.concatenate([directions, -directions]), np.full(2 * len(history), 0.511))
+
+
+def track_photon(position, direction, current_energy, cross_section_table, pztop, pzbottom, radius, stack, rng, history=0,
+                 event=None):
+    stats = prof.active()
+
+    summing_energy = 0
 
-        if energy2 < 0.001:
+    while current_energy > 0.001:
+
+        compton, photo, pair, total = cross_section_table.lookup(current_energy)
+
+        if total <= 0:
             break
-        
-        random_numbers = np.random.rand(2)
 
-        lambd = -np.log(random_numbers[0]) / total_cross_section
+        if stats is not None:
+            stats.count('steps')
+
+        lambd = -np.log(rng.random()) / total
 
-        if cgp.goes_outside(position2, direction2, pztop, pzbottom, radius, lambd):
+        if cgp.goes_outside(position, direction, pztop, pzbottom, radius, lambd):
+            if stats is not None:
+                stats.count('escapes')
             break
 
-        position2 += direction2 * lambd
+        position = position + direction * lambd
 
-        compton_scatter = random_numbers[1] < (compton_cross_section / total_cross_section)
-        if compton_scatter:
-            direction2, energy2, detector_energy = mci.compton_scatter_photon(energy2, direction2)
+        rand = rng.random() * total
 
-            summing_energy += detector_energy
+        if event is not None and rand < compton + photo + (pair if current_energy > 1.022 else 0):
+            if event['interactions'] == 0:
+                event['first_position'] = position
+            event['interactions'] += 1
 
-        photoelectric_absorb = random_numbers[1] < ((photoelectric_cross_section + compton_cross_section) / total_cross_section) and not compton_scatter
-        if photoelectric_absorb:
+        if rand < compton:
+            if stats is not None:
+                stats.count('compton')
+            direction, current_energy, deposited = mci.compton_scatter_photon(current_energy, direction, rng)
+            summing_energy += deposited
 
-            summing_energy += energy2
+        elif rand < compton + photo:
+            if stats is not None:
+                stats.count('photoelectric')
+            summing_energy += current_energy
             break
 
-
-        compton_cross_section = csd.get_cross_section(energy2, energy, compton_scattering_cross_sections)
-        photoelectric_cross_section = csd.get_cross_section(energy2, energy, photoelectric_absorption_cross_sections)
-        total_cross_section = compton_cross_section + photoelectric_cross_section
+        elif current_energy > 1.022:
+            if stats is not None:
+                stats.count('pair_production')
+            summing_energy += current_energy - 1.022
+            if event is not None:
+                event['pair'] = True
+            push_annihilation_photons(stack, np.array([history]), position[None, :], rng)
+            break
 
     return summing_energy
 
 
-def simulate_transport(source_position, source_energy, energy, compton_scattering_cross_sections,
-                        photoelectric_absorption_cross_sections, pair_production_cross_sections,
-                        pztop, pzbottom, radius, FWHM, num_photons, alpha, detector_height, detector_radius):
+def simulate_transport(source_position, source_energy, cross_section_table,
+                        pztop, pzbottom, radius, num_photons, source_sampler, streams, first_history=0, event_sink=None):
 
-    energy_accumulator = ec.EnergyHistogram(num_bins=1024, energy_min=0., energy_max = 1.1 * source_energy)
+    stats = prof.active()
+
+    energy_accumulator = ec.EnergyHistogram(num_bins=RAW_SPECTRUM_BINS, energy_min=0., energy_max = 1.1 * source_energy)
 
     reached_detector_num = 0
 
 
-    for _ in range(num_photons):
+    for history in range(first_history, first_history + num_photons):
 
-        current_energy = source_energy
+        # every history draws from its own stream, so it can be replayed on its own
+        rng = streams.history_generator(history)
 
-        direction = mci.isotropic_direction_in_cone(alpha, source_position, detector_height, detector_radius)
+        with prof.stage('source_sampling'):
+            direction = source_sampler.sample(1, rng)[0]
 
-        if np.sqrt(source_position[0]**2 + source_position[1]**2) < radius and source_position[2] < pztop and source_position[2] > pzbottom:  
-            position = source_position.copy() 
-        else:
-            position = cgp.intersect_cylinder_starting_points(source_position, direction, pztop, pzbottom, radius)
+        # the batch engine's entry rule: forward along the ray only, from the source itself when it is inside or on the surface
+        positions, reached = cgp.intersect_cylinder_starting_points_batch(np.asarray(source_position, dtype=float)[None],
+                                                                          direction[None], pztop, pzbottom, radius)
+        if not reached[0]:
+            continue
+
+        position = positions[0]
+
+        reached_detector_num += 1
+
+        stack = ParticleStack()
+        stack.push([0], [position], [direction], [source_energy])
 
         summing_energy = 0
+        event = None if event_sink is None else {'interactions': 0, 'first_position': np.full(3, np.nan), 'pair': False}
 
-        if position is not None: #reached the detector
-            reached_detector_num += 1
+        # annihilation photons land on the stack and are followed before the history ends
+        while len(stack):
+            _, positions, directions, energies = stack.pop_all()
+            for position, direction, current_energy in zip(positions, directions, energies):
+                summing_energy += track_photon(position, direction, current_energy, cross_section_table,
+                                               pztop, pzbottom, radius, stack, rng, history, event)
 
+        if summing_energy > 0:
+            with prof.stage('tally'):
+                energy_accumulator.add([summing_energy])
+                if event_sink is not None:
+                    event_sink.append([history], [summing_energy], [event['interactions']], [event['pair']],
+                                      [event['first_position']])
 
-        while position is not None and current_energy > 0.001:
+    if stats is not None:
+        stats.count('histories', num_photons)
+        stats.count('reached', reached_detector_num)
 
-            compton = csd.get_cross_section(current_energy, energy, compton_scattering_cross_sections)
-            photo = csd.get_cross_section(current_energy, energy, photoelectric_absorption_cross_sections)
-            pair = csd.get_cross_section(current_energy, energy, pair_production_cross_sections) if current_energy > 1.022 else 0
-            total = compton + photo + pair
+    E_int = reached_detector_num * source_energy
 
-            if total <= 0:
-                break  
+    return energy_accumulator, E_int
 
-            lambd = -np.log(np.random.rand()) / total
 
-            if cgp.goes_outside(position, direction, pztop, pzbottom, radius, lambd):
-                if summing_energy > 0:
-                    energy_accumulator.add([summing_energy * np.random.normal(1, FWHM/2.3548)])
-                break
+def transport_photons(positions, directions, energies, cross_section_table, pztop, pzbottom, radius, rng, event_details=False,
+                      variance_reduction=None, weights=None):
+    stats = prof.active()
 
-            position += direction * lambd
+    # weights holds one statistical weight per history and is updated in place
+    forced_step = variance_reduction is not None and variance_reduction.forced_interaction
+    roulette_energy = None if variance_reduction is None else variance_reduction.roulette_energy
 
+    summing_energy = np.zeros(len(energies))
 
-            rand = np.random.rand() * total
-            if rand < compton:
-                direction, current_energy, deposited = mci.compton_scatter_photon(current_energy, direction)
-                summing_energy += deposited
-                
-            elif rand < compton + photo:
-                summing_energy += current_energy
-                break
-                
-            elif current_energy > 1.022:
-                pair_energy = pair_production_simulation(position, energy, pztop, pzbottom, radius,
-                                                    compton_scattering_cross_sections, 
-                                                    photoelectric_absorption_cross_sections)
-                summing_energy += current_energy - 1.022 + pair_energy
-                break
+    if event_details:
+        interactions = np.zeros(len(energies), dtype=np.int32)
+        first_positions = np.full((len(energies), 3), np.nan)
+        pair_produced = np.zeros(len(energies), dtype=bool)
+
+    # structure of arrays for the live photons; history maps them back to summing_energy
+    stack = ParticleStack()
+    history = np.arange(len(energies))
+    positions = np.array(positions, dtype=float)
+    directions = np.array(directions, dtype=float)
+    energies = np.array(energies, dtype=float)
+
+    while history.size:
+
+        if roulette_energy is not None:
+            # the game is played on whole histories, as a pulse-height tally only sees their summed deposit
+            roulette_weight = variance_reduction.roulette_weight
+            candidates = (energies < roulette_energy) & (weights[history] < roulette_weight)
+            if candidates.any():
+                games = np.unique(history[candidates])
+                survived = rng.random(games.size) * roulette_weight < weights[games]
+                weights[games] = np.where(survived, roulette_weight, 0.0)
+
+                if stats is not None:
+                    stats.count('roulette_kills', np.count_nonzero(~survived))
+
+                alive = weights[history] > 0
+                history, positions, directions, energies = history[alive], positions[alive], directions[alive], energies[alive]
+
+        compton, photo, pair, total = cross_section_table.lookup(energies)
+
+        alive = (energies > 0.001) & (total > 0)
+
+        if forced_step:
+            # the first flight of every primary is sampled within its chord, weighted by the chance it interacts at all
+            chord = cgp.intersect_cylinder_in_batch(positions, directions, pztop, pzbottom, radius)
+            interacts = -np.expm1(-np.where(alive, total, 0.0) * chord)
+            lambd = np.minimum(-np.log1p(-rng.random(history.size) * interacts) / np.where(alive, total, 1.0), chord)
+            weights[history] *= interacts
+            escaped = alive & (interacts <= 0)
+            forced_step = False
+        else:
+            lambd = -np.log(rng.random(history.size)) / np.where(alive, total, 1.0)
+            escaped = alive & cgp.goes_outside_batch(positions, directions, pztop, pzbottom, radius, lambd)
+
+        if stats is not None:
+            stats.count('steps', np.count_nonzero(alive))
+            stats.count('escapes', np.count_nonzero(escaped))
+
+        alive &= ~escaped
+
+        history, positions, directions, energies = history[alive], positions[alive], directions[alive], energies[alive]
+        compton, photo, total, lambd = compton[alive], photo[alive], total[alive], lambd[alive]
+
+        positions += directions * lambd[:, None]
+
+        rand = rng.random(history.size) * total
+        compton_scatter = rand < compton
+        photoelectric_absorb = ~compton_scatter & (rand < compton + photo)
+        pair_production = ~compton_scatter & ~photoelectric_absorb & (energies > 1.022)
+
+        if stats is not None:
+            stats.count('compton', np.count_nonzero(compton_scatter))
+            stats.count('photoelectric', np.count_nonzero(photoelectric_absorb))
+            stats.count('pair_production', np.count_nonzero(pair_production))
+
+        if event_details:
+            interacting = compton_scatter | photoelectric_absorb | pair_production
+            first = interacting & (interactions[history] == 0)
+            first_positions[history[first]] = positions[first]
+            np.add.at(interactions, history[interacting], 1)
+            pair_produced[history[pair_production]] = True
+
+        # several photons of one history can be live at once, so deposits are accumulated with add.at
+        np.add.at(summing_energy, history[photoelectric_absorb], energies[photoelectric_absorb])
+
+        if pair_production.any():
+            np.add.at(summing_energy, history[pair_production], energies[pair_production] - 1.022)
+            push_annihilation_photons(stack, history[pair_production], positions[pair_production], rng)
+
+        if compton_scatter.any():
+            directions[compton_scatter], energies[compton_scatter], deposited = cs.compton_scatter_photons(
+                energies[compton_scatter], directions[compton_scatter], rng)
+            np.add.at(summing_energy, history[compton_scatter], deposited)
+
+        alive = ~photoelectric_absorb & ~pair_production
+        history, positions, directions, energies = history[alive], positions[alive], directions[alive], energies[alive]
+
+        if len(stack):
+            secondaries = stack.pop_all()
+            history, positions, directions, energies = (np.concatenate([live, secondary]) for live, secondary
+                                                        in zip((history, positions, directions, energies), secondaries))
+
+    if event_details:
+        return summing_energy, interactions, first_positions, pair_produced
+
+    return summing_energy
+
+
+def _simulate_block(block, first_history, last_history, source_position, source_energy, cross_section_table,
+                    pztop, pzbottom, radius, source_sampler, streams, event_details=False, variance_reduction=None,
+                    backend='numpy'):
+    n = last_history - first_history
+
+    # one stream per block, so a block draws the same numbers whichever chunk or worker runs it
+    rng = streams.block_generator(block)
+
+    with prof.stage('source_sampling'):
+        directions = source_sampler.sample(n, rng)
+    sources = np.tile(np.asarray(source_position, dtype=float), (n, 1))
+
+    positions, reached = cgp.intersect_cylinder_starting_points_batch(sources, directions, pztop, pzbottom, radius)
+
+    stats = prof.active()
+    if stats is not None:
+        stats.count('histories', n)
+        stats.count('reached', len(positions))
+
+    summing_energy = np.zeros(n)
+
+    # the compiled kernel follows each history on its own stream, keyed by the history number
+    if backend == 'numba':
+        import numba_transport as nt
+        summing_energy[reached] = nt.transport_photons(positions, directions[reached], first_history + np.flatnonzero(reached),
+                                                       source_energy, cross_section_table, pztop, pzbottom, radius, streams)
+        return summing_energy, reached, None, None
+
+    reached_weights = None if variance_reduction is None else np.ones(len(positions))
+    results = transport_photons(positions, directions[reached], np.full(len(positions), float(source_energy)),
+                                cross_section_table, pztop, pzbottom, radius, rng, event_details,
+                                variance_reduction, reached_weights)
+
+    weights = None
+    if variance_reduction is not None:
+        weights = np.zeros(n)
+        weights[reached] = reached_weights
+
+    if not event_details:
+        summing_energy[reached] = results
+        return summing_energy, reached, weights, None
+
+    details = {'interactions': np.zeros(n, dtype=np.int32), 'first_position': np.full((n, 3), np.nan),
+               'pair': np.zeros(n, dtype=bool)}
+    summing_energy[reached], details['interactions'][reached], details['first_position'][reached], details['pair'][reached] = results
+
+    return summing_energy, reached, weights, details
+
+
+def history_deposits(first_history, num_histories, source_position, source_energy, cross_section_table,
+                     pztop, pzbottom, radius, source_sampler, streams, num_photons=None):
+    # the deposits of these histories in a run of num_photons, by default a run that ends with them
+    end = first_history + num_histories
+    num_photons = end if num_photons is None else num_photons
+    if num_photons < end:
+        raise ValueError("The histories must lie within the run.")
+
+    # a block depends on its whole range of histories, cut short by the end of the run, so whole blocks are drawn
+    block_start = first_history - first_history % streams.block_size
+    block_end = min(-(-end // streams.block_size) * streams.block_size, num_photons)
+
+    summing_energy = np.zeros(block_end - block_start)
+    reached = np.zeros(block_end - block_start, dtype=bool)
+
+    for block, start, stop in streams.blocks(block_start, block_end - block_start):
+        block_slice = slice(start - block_start, stop - block_start)
+        summing_energy[block_slice], reached[block_slice], _, _ = _simulate_block(block, start, stop, source_position, source_energy,
+                                                                            cross_section_table, pztop, pzbottom, radius,
+                                                                            source_sampler, streams)
+
+    rows = slice(first_history - block_start, end - block_start)
+    return summing_energy[rows], reached[rows]
+
+
+def replay_history(history, num_photons, source_position, source_energy, cross_section_table,
+                   pztop, pzbottom, radius, source_sampler, streams):
+    summing_energy, _ = history_deposits(history, 1, source_position, source_energy, cross_section_table,
+                                         pztop, pzbottom, radius, source_sampler, streams, num_photons=num_photons)
+
+    return summing_energy[0]
 
-        if summing_energy > 0:
-            energy_accumulator.add([summing_energy * np.random.normal(1, FWHM / 2.3548)])
+
+def simulate_transport_batch(source_position, source_energy, cross_section_table,
+                             pztop, pzbottom, radius, num_photons, source_sampler,
+                             streams, first_history=0, energy_max=None, event_sink=None, variance_reduction=None, backend='numpy'):
+
+    if energy_max is None:
+        energy_max = 1.1 * source_energy
+
+    energy_accumulator = ec.EnergyHistogram(num_bins=RAW_SPECTRUM_BINS, energy_min=0., energy_max=energy_max)
+
+    reached_detector_num = 0
+
+    for block, start, stop in streams.blocks(first_history, num_photons):
+        summing_energy, reached, weights, details = _simulate_block(block, start, stop, source_position, source_energy,
+                                                                    cross_section_table, pztop, pzbottom, radius, source_sampler,
+                                                                    streams, event_sink is not None, variance_reduction, backend)
+
+        reached_detector_num += np.count_nonzero(reached)
+
+        with prof.stage('tally'):
+            deposited = summing_energy > 0
+            if weights is not None:
+                deposited &= weights > 0
+                weights = weights[deposited]
+
+            energy_accumulator.add(summing_energy[deposited], weights)
+            if event_sink is not None:
+                event_sink.append(np.arange(start, stop)[deposited], summing_energy[deposited], details['interactions'][deposited],
+                                  details['pair'][deposited], details['first_position'][deposited], weights)
 
     E_int = reached_detector_num * source_energy
 
     return energy_accumulator, E_int
 
 
-def record_gamma_spectrum(source_position, source_energy, detector_height, detector_radius, NaI_density, FWHM, num_particles, cross_sections_file_path=None):
+def _simulate_chunk(args):
+    simulate_batch, simulation_args, num_photons, source_sampler, streams, first_history, energy_max, profile, event_path, options = args
+
+    event_sink = None if event_path is None else eo.EventSink(event_path)
+    if event_sink is not None:
+        options = {**options, 'event_sink': event_sink}
+
+    # the processes already share out the cores
+    if options.get('backend') == 'numba':
+        import numba_transport as nt
+        nt.set_num_threads(1)
+
+    # worker processes collect their own stats and hand them back with the spectrum
+    with prof.collecting(prof.TransportStats() if profile else None) as stats:
+        energy_accumulator, E_int = simulate_batch(*simulation_args, num_photons, source_sampler, streams,
+                                                   first_history=first_history, energy_max=energy_max, **options)
+
+    if event_sink is not None:
+        event_sink.close()
+
+    return energy_accumulator, E_int, stats
+
+
+def simulate_in_chunks(simulate_batch, simulation_args, num_photons, source_sampler, streams, workers=1, first_history=0,
+                       energy_max=None, event_sink=None, mp_context=None, **options):
+    # simulate_batch is an engine's block loop, called as simulate_batch(*simulation_args, num_photons, source_sampler,
+    # streams, first_history=, energy_max=, **options); workers unpickle it, so it has to be a module-level function
+    stats = prof.active()
+
+    # every worker writes its events to its own part file, appended to the sink in chunk order
+    chunks = [(simulate_batch, simulation_args, chunk_size, source_sampler, streams, first_history + chunk_start, energy_max,
+               stats is not None, None if event_sink is None else f"{event_sink.path}.part{chunk}", options)
+              for chunk, (chunk_start, chunk_size) in enumerate(streams.split(num_photons, workers))]
+
+    if len(chunks) == 1:
+        if event_sink is not None:
+            options = {**options, 'event_sink': event_sink}
+        return simulate_batch(*simulation_args, chunks[0][2], source_sampler, streams, first_history=chunks[0][5],
+                              energy_max=energy_max, **options)
+
+    with ProcessPoolExecutor(max_workers=len(chunks), mp_context=mp_context) as executor:
+        results = list(executor.map(_simulate_chunk, chunks))
+
+    if event_sink is not None:
+        for *_, event_path, _ in chunks:
+            event_sink.append_file(event_path)
+            os.remove(event_path)
+            os.remove(f"{event_path}.json")
+
+    energy_accumulator, E_int, _ = results[0]
+    for chunk_accumulator, chunk_E_int, _ in results[1:]:
+        energy_accumulator.merge(chunk_accumulator)
+        E_int += chunk_E_int
+
+    if stats is not None:
+        for _, _, chunk_stats in results:
+            stats.merge(chunk_stats)
+
+    return energy_accumulator, E_int
+
+
+def simulate_transport_parallel(source_position, source_energy, cross_section_table,
+                                pztop, pzbottom, radius, num_photons, source_sampler,
+                                streams, workers=1, first_history=0, energy_max=None, event_sink=None, variance_reduction=None,
+                                backend='numpy'):
+
+    # numba's thread pool does not survive a fork, so its workers start from a fresh interpreter
+    mp_context = multiprocessing.get_context('spawn') if backend == 'numba' else None
+
+    return simulate_in_chunks(simulate_transport_batch, (source_position, source_energy, cross_section_table, pztop, pzbottom, radius),
+                              num_photons, source_sampler, streams, workers=workers, first_history=first_history,
+                              energy_max=energy_max, event_sink=event_sink, mp_context=mp_context,
+                              variance_reduction=variance_reduction, backend=backend)
+
+
+def efficiencies(E_det, E_int, emitted_per_sampled, num_particles, source_energy):
+    # the total efficiency is per emitted photon, of which the sampled directions are only the share towards the crystal
+    E_tot = emitted_per_sampled * num_particles * source_energy
+
+    efficiency_tot = E_det / E_tot if E_tot > 0 else 0.
+    efficiency_int = E_det / E_int if E_int > 0 else 0.
+
+    return efficiency_tot, efficiency_int
+
+
+def spectrum_efficiencies(energy_accumulator, E_int, source_sampler, num_particles, source_energy, FWHM,
+                          resolution_model='proportional'):
+    efficiency_tot, efficiency_int = efficiencies(ec.total_energy_in_histogram(energy_accumulator), E_int,
+                                                  source_sampler.emitted_per_sampled, num_particles, source_energy)
+
+    if FWHM is not None:
+        with prof.stage('broadening'):
+            energy_accumulator = dr.broaden_histogram(energy_accumulator, FWHM, model=resolution_model, num_bins=1024)
+
+    return energy_accumulator, efficiency_tot, efficiency_int
+
+
+def record_gamma_spectrum(source_position, source_energy, detector_height, detector_radius, NaI_density, FWHM, num_particles, cross_sections_file_path=None, batch_size=None, workers=1, seed=None, resolution_model='proportional', source_sampling='cylinder', profile=False, event_file=None,
+                          variance_reduction=None, backend=None):
 
     if cross_sections_file_path is None:
         raise ValueError("Cross sections file path must be provided.")
 
-    energy, compton_scattering_cross_sections, photoelectric_absorption_cross_sections, pair_production_cross_sections = csd.read_cross_sections(cross_sections_file_path)
+    if workers < 1:
+        raise ValueError("Number of workers must be at least 1.")
+
+    # by default the scalar engine runs unless batches, workers or weighted histories ask for the batch engine
+    if backend is None:
+        backend = 'python' if batch_size is None and workers == 1 and variance_reduction is None else 'numpy'
+    backend = select_backend(backend)
+
+    if backend == 'python' and (workers > 1 or variance_reduction is not None):
+        raise ValueError("The python backend runs a single process without variance reduction.")
+    if backend == 'numba' and (variance_reduction is not None or event_file is not None):
+        raise ValueError("The numba backend does not support variance reduction or event output.")
+
+    start_time = time.perf_counter()
+
+    with prof.collecting(prof.TransportStats() if profile else None) as stats:
+
+        with prof.stage('setup'):
+            cross_section_table = csd.load_cross_section_table(cross_sections_file_path, NaI_density)
+
+            source_sampler = ss.make_source_sampler(source_position, detector_height, detector_radius, source_sampling)
+
+        pztop = detector_height / 2
+        pzbottom = -detector_height / 2
+
+        streams = rs.RandomStreams(seed, block_size=batch_size or rs.DEFAULT_BLOCK_SIZE)
+
+        event_sink = None if event_file is None else eo.EventSink(event_file)
+
+        try:
+            if backend == 'python':
+                energy_accumulator, E_int = simulate_transport(source_position, source_energy, cross_section_table,
+                                    pztop, pzbottom, detector_radius, num_particles, source_sampler, streams,
+                                    event_sink=event_sink)
+            else:
+                energy_accumulator, E_int = simulate_transport_parallel(source_position, source_energy, cross_section_table,
+                                    pztop, pzbottom, detector_radius, num_particles, source_sampler,
+                                    streams, workers=workers, event_sink=event_sink,
+                                    variance_reduction=variance_reduction, backend=backend)
+        finally:
+            if event_sink is not None:
+                event_sink.close()
+
+        energy_accumulator, efficiency_tot, efficiency_int = spectrum_efficiencies(energy_accumulator, E_int, source_sampler,
+                                                                                   num_particles, source_energy, FWHM,
+                                                                                   resolution_model)
+
+    if profile:
+        stats.wall_time = time.perf_counter() - start_time
+        return energy_accumulator, efficiency_tot, efficiency_int, stats
+
+    return energy_accumulator, efficiency_tot, efficiency_int
 
-    energy = csd.make_energy_unique(energy)
 
+def record_gamma_spectrum_adaptive(source_position, source_energy, detector_height, detector_radius, NaI_density, FWHM,
+                                   cross_sections_file_path=None, relative_error=0.01, time_limit=None, max_particles=None,
+                                   photopeak_window=None, batch_particles=50000, batch_size=rs.DEFAULT_BLOCK_SIZE, workers=1, seed=None,
+                                   resolution_model='proportional', source_sampling='cylinder'):
 
+    if cross_sections_file_path is None:
+        raise ValueError("Cross sections file path must be provided.")
+    if relative_error is None and time_limit is None and max_particles is None:
+        raise ValueError("At least one of relative_error, time_limit or max_particles must be given.")
+
+    start_time = time.perf_counter()
 
-    compton_scattering_cross_sections *= NaI_density
-    photoelectric_absorption_cross_sections *= NaI_density
-    pair_production_cross_sections *= NaI_density
+    cross_section_table = csd.load_cross_section_table(cross_sections_file_path, NaI_density)
 
-    alpha = cgp.calc_angle_of_cone(source_position, detector_height, detector_radius)
+    source_sampler = ss.make_source_sampler(source_position, detector_height, detector_radius, source_sampling)
 
     pztop = detector_height / 2
     pzbottom = -detector_height / 2
 
-    energy_accumulator, E_int = simulate_transport(source_position, source_energy, energy, compton_scattering_cross_sections,
-                        photoelectric_absorption_cross_sections, pair_production_cross_sections,
-                        pztop, pzbottom, detector_radius, FWHM, num_particles, alpha, detector_height, detector_radius)
-    
-    E_det = ec.total_energy_in_histogram(energy_accumulator)
+    streams = rs.RandomStreams(seed, block_size=batch_size)
+
+    # whole blocks per step, so the histories run here match those of a fixed-size run with the same seed
+    batch_particles = -(-batch_particles // batch_size) * batch_size
+
+    energy_accumulator = None
+    num_particles = 0
+    E_int = 0.
+
+    while True:
+        n = batch_particles if max_particles is None else min(batch_particles, max_particles - num_particles)
+
+        batch_accumulator, batch_E_int = simulate_transport_parallel(source_position, source_energy, cross_section_table,
+                            pztop, pzbottom, detector_radius, n, source_sampler,
+                            streams, workers=workers, first_history=num_particles)
+
+        energy_accumulator = batch_accumulator if energy_accumulator is None else energy_accumulator.merge(batch_accumulator)
+        num_particles += n
+        E_int += batch_E_int
+
+        error_tot, error_int = ec.efficiency_relative_errors(energy_accumulator, num_particles, E_int / source_energy)
+        errors = [error_tot, error_int]
+
+        photopeak_counts = photopeak_error = None
+        if photopeak_window is not None:
+            photopeak_counts = ec.window_counts(energy_accumulator, *photopeak_window)
+            photopeak_error = (np.sqrt(photopeak_counts * (1 - photopeak_counts / num_particles)) / photopeak_counts
+                               if photopeak_counts > 0 else np.inf)
+            errors.append(photopeak_error)
+
+        elapsed_time = time.perf_counter() - start_time
+
+        converged = relative_error is not None and max(errors) <= relative_error
+        if converged:
+            break
+        if time_limit is not None and elapsed_time >= time_limit:
+            break
+        if max_particles is not None and num_particles >= max_particles:
+            break
+
+    efficiency_tot, efficiency_int = efficiencies(ec.total_energy_in_histogram(energy_accumulator), E_int,
+                                                  source_sampler.emitted_per_sampled, num_particles, source_energy)
 
-    if np.linalg.norm(source_position) < np.sqrt(detector_radius**2 + detector_height**2 / 4):
-        E_tot = num_particles * source_energy
-    else:
-        E_tot = (2 / (1 - np.cos(alpha))) * num_particles * source_energy
+    report = {
+        'num_particles': num_particles,
+        'efficiency_tot_error': float(error_tot),
+        'efficiency_int_error': float(error_int),
+        'photopeak_counts': photopeak_counts,
+        'photopeak_error': None if photopeak_error is None else float(photopeak_error),
+        'elapsed_time': elapsed_time,
+        'converged': bool(converged),
+        'solid_angle': float(source_sampler.solid_angle),
+    }
 
-    efficiency_tot = E_det / E_tot
-    efficiency_int = E_det / E_int
+    if FWHM is not None:
+        energy_accumulator = dr.broaden_histogram(energy_accumulator, FWHM, model=resolution_model, num_bins=1024)
 
-    return energy_accumulator, efficiency_tot, efficiency_int
\ No newline at end of file
+    return energy_accumulator, efficiency_tot, efficiency_int, report